@@ -0,0 +1,373 @@
+"""
+Offline benchmarks for the OpenXiino encoders, HTML parser and dataserver.
+
+Everything runs against the checked-in corpus in bench/corpus: pages are
+served by a local stand-in for the upstream web server, so results don't
+depend on the network or on live sites.
+
+Usage, from the repository root:
+    python bench/run_benchmarks.py [--repeat N] [--only GROUP ...]
+                                   [--json FILE] [--baseline FILE]
+
+Save a run with --json, then pass that file as --baseline to a later run
+to see how the median time of each benchmark has changed.
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import socket
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+# pylint: disable=wrong-import-position
+import PIL.Image
+import lib.mode9 as mode9
+import lib.scanline as scanline
+from dataserver import XiinoDataServer
+from lib.image_cache import ImageCache
+from lib.image_pipeline import ImagePipeline
+from lib.pooled_http_server import PooledHTTPServer
+from lib.xiino_html_converter import XiinoHTMLParser
+from lib.xiino_image_converter import EBDConverter
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+IMAGES = sorted((CORPUS / "images").iterdir())
+# The thumbnails are there for the gallery page; one is enough on its own.
+CODEC_IMAGES = [
+    path
+    for path in IMAGES
+    if not path.name.startswith("thumb") or path.name == "thumb00.jpg"
+]
+PAGES = sorted((CORPUS / "pages").iterdir())
+
+GROUPS = ("decode", "mode9", "scanline", "converter", "parser", "end_to_end")
+
+CONVERSIONS = {
+    "mode0": ("convert_bw", {}),
+    "mode1": ("convert_bw", {"compressed": True}),
+    "mode2": ("convert_gs", {"depth": 2}),
+    "mode3": ("convert_gs", {"depth": 2, "compressed": True}),
+    "mode4": ("convert_gs", {"depth": 4}),
+    "mode5": ("convert_gs", {"depth": 4, "compressed": True}),
+    "mode8": ("convert_colour", {}),
+    "mode9": ("convert_colour", {"compressed": True}),
+}
+
+
+@dataclass
+class Result:
+    "Timings and sizes for one benchmark."
+
+    group: str
+    name: str
+    timings: list[float]
+    input_bytes: int
+    output_bytes: int
+
+    @property
+    def key(self) -> str:
+        "Name used to match results between runs."
+        return f"{self.group}/{self.name}"
+
+    def summary(self) -> dict:
+        "Latency percentiles (ms), throughput (input MB/s) and sizes."
+        median = percentile(self.timings, 50)
+        return {
+            "runs": len(self.timings),
+            "p50_ms": median * 1000,
+            "p90_ms": percentile(self.timings, 90) * 1000,
+            "p99_ms": percentile(self.timings, 99) * 1000,
+            "mb_per_s": self.input_bytes / median / 1e6 if median else 0.0,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "ratio": self.output_bytes / self.input_bytes if self.input_bytes else 0.0,
+        }
+
+
+def percentile(values: list[float], pct: float) -> float:
+    "Nearest-rank percentile."
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure(function, repeat: int) -> tuple[list[float], object]:
+    "Run `function` once to warm up, then `repeat` times, timing each run."
+    result = function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def scaled_images() -> dict[str, PIL.Image.Image]:
+    "Corpus images, scaled to 153px the way the dataserver would."
+    return {
+        path.name: EBDConverter(PIL.Image.open(path)).image for path in CODEC_IMAGES
+    }
+
+
+def bench_decode(repeat: int, **_) -> list[Result]:
+    "Open, decode and scale each corpus image (EBDConverter.__init__)."
+    results = []
+    for path in CODEC_IMAGES:
+        data = path.read_bytes()
+        timings, converter = measure(
+            lambda data=data: EBDConverter(PIL.Image.open(io.BytesIO(data))), repeat
+        )
+        image = converter.image
+        results.append(
+            Result(
+                "decode",
+                path.name,
+                timings,
+                len(data),
+                image.width * image.height * 3,
+            )
+        )
+    return results
+
+
+def bench_mode9(repeat: int, **_) -> list[Result]:
+    "mode9.compress_mode9 with each engine. Input is one byte per pixel."
+    results = []
+    for name, image in scaled_images().items():
+        for engine in ("numpy", "python", "optimal"):
+            timings, output = measure(
+                functools.partial(mode9.compress_mode9, image, engine=engine), repeat
+            )
+            results.append(
+                Result(
+                    "mode9",
+                    f"{engine}/{name}",
+                    timings,
+                    image.width * image.height,
+                    len(output),
+                )
+            )
+    return results
+
+
+def bench_scanline(repeat: int, **_) -> list[Result]:
+    "scanline.compress_data_with_scanline on 1, 2 and 4-bit image data."
+    results = []
+    for name, image in scaled_images().items():
+        converter = EBDConverter(image, override_scale_logic=True)
+        for bits, raw in (
+            (1, converter.convert_bw().raw_data),
+            (2, converter.convert_gs(depth=2).raw_data),
+            (4, converter.convert_gs(depth=4).raw_data),
+        ):
+            width_bytes = -(-image.width * bits // 8)
+            timings, output = measure(
+                functools.partial(
+                    scanline.compress_data_with_scanline, raw, width_bytes
+                ),
+                repeat,
+            )
+            results.append(
+                Result("scanline", f"{bits}bit/{name}", timings, len(raw), len(output))
+            )
+    return results
+
+
+def bench_converter(repeat: int, **_) -> list[Result]:
+    "Every EBDConverter mode, on already-scaled images."
+    results = []
+    for name, image in scaled_images().items():
+        converter = EBDConverter(image, override_scale_logic=True)
+        for mode, (method, kwargs) in CONVERSIONS.items():
+            timings, output = measure(
+                functools.partial(getattr(converter, method), **kwargs), repeat
+            )
+            results.append(
+                Result(
+                    "converter",
+                    f"{mode}/{name}",
+                    timings,
+                    image.width * image.height * 3,
+                    len(output.raw_data),
+                )
+            )
+    return results
+
+
+def bench_parser(repeat: int, upstream: str, **_) -> list[Result]:
+    """
+    XiinoHTMLParser.feed + get_parsed_data on each page, including fetching
+    and converting its images from the stand-in upstream.
+    """
+    pipeline = ImagePipeline()
+    results = []
+    for path in PAGES:
+        html = path.read_text(encoding="utf-8")
+        base_url = f"{upstream}/pages/{path.name}"
+
+        def parse(html=html, base_url=base_url):
+            parser = XiinoHTMLParser(base_url=base_url, image_pipeline=pipeline)
+            parser.feed(html)
+            return parser.get_parsed_data()
+
+        timings, output = measure(parse, repeat)
+        results.append(
+            Result(
+                "parser",
+                path.name,
+                timings,
+                len(html.encode("utf-8")),
+                len(output.encode("latin-1", errors="ignore")),
+            )
+        )
+    pipeline.shutdown()
+    return results
+
+
+def bench_end_to_end(repeat: int, upstream: str, dataserver: str, **_) -> list[Result]:
+    """
+    Full requests to a local dataserver, which fetches from the stand-in
+    upstream. "cold" runs have the image cache turned off.
+    """
+    host, port = dataserver.split(":")
+    results = []
+    for cache_state in ("cold", "cached"):
+        XiinoDataServer.IMAGE_CACHE = ImageCache(
+            max_bytes=0 if cache_state == "cold" else 32 * 1024 * 1024
+        )
+        for path in PAGES:
+            request = (
+                f"GET /c8/w153/?{upstream}/pages/{path.name} HTTP/1.0\r\n\r\n"
+            ).encode("latin-1")
+            timings, output = measure(
+                functools.partial(fetch, host, int(port), request), repeat
+            )
+            results.append(
+                Result(
+                    "end_to_end",
+                    f"{cache_state}/{path.name}",
+                    timings,
+                    path.stat().st_size,
+                    len(output),
+                )
+            )
+    return results
+
+
+def fetch(host: str, port: int, request: bytes) -> bytes:
+    "Send a raw request and read the whole response."
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall(request)
+        chunks = []
+        while chunk := connection.recv(65536):
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+class QuietFileHandler(http.server.SimpleHTTPRequestHandler):
+    "Serves the corpus without logging every request."
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class QuietDataServer(XiinoDataServer):
+    "The real request handler, without logging every request."
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def start_server(server) -> str:
+    "Serve in a background thread, returning host:port."
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return f"{host}:{port}"
+
+
+def print_table(results: list[Result], baseline: dict | None):
+    "Print one row per benchmark."
+    header = (
+        f"{'benchmark':<36} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+        f"{'MB/s':>8} {'out bytes':>10} {'ratio':>7}"
+    )
+    if baseline is not None:
+        header += f" {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        summary = result.summary()
+        line = (
+            f"{result.key:<36} {summary['p50_ms']:>9.2f} {summary['p90_ms']:>9.2f} "
+            f"{summary['p99_ms']:>9.2f} {summary['mb_per_s']:>8.2f} "
+            f"{summary['output_bytes']:>10} {summary['ratio']:>7.3f}"
+        )
+        if baseline is not None:
+            before = baseline.get(result.key)
+            if before and before["p50_ms"]:
+                change = (summary["p50_ms"] / before["p50_ms"] - 1) * 100
+                line += f" {change:>+7.1f}%"
+            else:
+                line += f" {'new':>8}"
+        print(line)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument(
+        "--repeat", type=int, default=5, help="timed runs per benchmark (default: 5)"
+    )
+    arg_parser.add_argument(
+        "--only", nargs="+", choices=GROUPS, help="only run these groups"
+    )
+    arg_parser.add_argument("--json", type=Path, help="save results to this file")
+    arg_parser.add_argument(
+        "--baseline", type=Path, help="compare with results saved by --json"
+    )
+    args = arg_parser.parse_args()
+
+    upstream_server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietFileHandler, directory=str(CORPUS))
+    )
+    upstream = "http://" + start_server(upstream_server)
+    data_server = PooledHTTPServer(("127.0.0.1", 0), QuietDataServer, workers=4)
+    dataserver = start_server(data_server)
+
+    results = []
+    # the parser and dataserver print progress, keep it out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for group in args.only or GROUPS:
+            results.extend(
+                globals()[f"bench_{group}"](
+                    args.repeat, upstream=upstream, dataserver=dataserver
+                )
+            )
+
+    data_server.shutdown()
+    data_server.server_close()
+    upstream_server.shutdown()
+    upstream_server.server_close()
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    print_table(results, baseline)
+
+    if args.json:
+        args.json.write_text(
+            json.dumps({result.key: result.summary() for result in results}, indent=1),
+            encoding="utf-8",
+        )
+
+
+if __name__ == "__main__":
+    main()
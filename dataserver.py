@@ -1,8 +1,25 @@
-import requests
+import argparse
+import cProfile
+import html
+import io
+import os
+import pstats
 import re
-import http.server
+import signal
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
 from http.server import BaseHTTPRequestHandler
-from lib.xiino_html_converter import XiinoHTMLParser
+import requests
+from lib.xiino_html_converter import DEFERRED_IMAGE_URL, XiinoHTMLParser
+import lib.http_client as http_client
+import lib.mode9 as mode9
+from lib.device_profile import DeviceProfile
+from lib.encoding_pool import EncodingPool
+from lib.image_cache import ImageCache
+from lib.image_pipeline import ImageBudget, ImagePipeline
+from lib.metrics import METRICS, RequestTimings, format_number
+from lib.pooled_http_server import PooledHTTPServer
 import base64
 
 import yattag
@@ -13,55 +30,164 @@ def iso8859(string: str) -> bytes:
     return bytes(string, encoding="iso-8859-1")
 
 
+def busy_response() -> bytes:
+    "The complete response sent when every worker is busy."
+    return (
+        iso8859("HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n")
+        + bytes([0x00] * 12)
+        + bytes([0x0D, 0x0A] * 2)
+        + iso8859(
+            "<HTML><TITLE>Server Busy</TITLE><BODY><H1>Server Busy</H1>"
+            "<P>The OpenXiino dataserver is handling too many requests. "
+            "Please try again in a moment.</P></BODY></HTML>"
+        )
+    )
+
+
 class XiinoDataServer(BaseHTTPRequestHandler):
     DATASERVER_VERSION = "Pre-Alpha Development Release"
 
-    COLOUR_DEPTH_REGEX = re.compile(r"\/c([0-9]*)\/")
-    GSCALE_DEPTH_REGEX = re.compile(r"\/g([0-9]*)\/")
-    SCREEN_WIDTH_REGEX = re.compile(r"\/w([0-9]*)\/")
-    TXT_ENCODING_REGEX = re.compile(r"\/[de]{1,2}([a-zA-Z0-9-]*)\/")
     URL_REGEX = re.compile(r"\/\?(.*)\s")  # damn, length sync broken :(
 
     REQUESTS_HEADER = {
         "User-Agent": "OpenXiino/1.0 (http://github.com/nicl83/openxiino) python-requests/2.27.1"
     }
 
+    # Shared by every request, so the per-host limits apply server-wide.
+    IMAGE_PIPELINE = ImagePipeline(max_workers=8, per_host_limit=4)
+    IMAGE_CACHE = ImageCache()
+    # Set up in __main__, as the worker processes need the main module guard.
+    ENCODING_POOL: EncodingPool | None = None
+    MODE9_ENGINE = "numpy"
+    # "auto" sends whichever of the compressed and uncompressed modes is smaller.
+    IMAGE_MODE = "auto"
+    # Upstream pages are cut off after this much.
+    MAX_PAGE_BYTES = 1024 * 1024
+    # Images past this become links to a page with just that image.
+    IMAGE_BUDGET = ImageBudget(max_images=40, max_bytes=192 * 1024, max_seconds=15)
+    # Bigger images are skipped; they'd take too much memory to convert.
+    MAX_IMAGE_BYTES = 4 * 1024 * 1024
+    MAX_IMAGE_PIXELS = 25_000_000
+    # Time for a whole request: the page fetch, then its images. Whatever
+    # isn't done by then is left out, so Xiino gets something before it gives up.
+    PAGE_DEADLINE_SECONDS = 20
+    # Where http://profile/ saves its stats; profiling is off while this is None.
+    PROFILE_DIR: str | None = None
+    PROFILE_URL = "http://profile/?"
+    # Only one profiler can run at a time (cProfile raises otherwise on 3.12+).
+    PROFILE_LOCK = threading.Lock()
+
     def do_GET(self):
+        if self.path == "/metrics":
+            self.metrics_text()
+            return
+
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
         url = self.URL_REGEX.search(self.requestline)
+        self.device_profile = DeviceProfile.from_request_line(self.requestline)
+        self.timings = RequestTimings()
+        self.deadline = self.timings.started + self.PAGE_DEADLINE_SECONDS
+        status = "error"
 
         # send magic padding xiino expects
         self.wfile.write(bytes([0x00] * 12))
         self.wfile.write(bytes([0x0D, 0x0A] * 2))
         # TODO: real actual websites
-        if url:
-            print(url)
-            url = url.group(1)
-            if url == "http://about/":
-                self.about()
-            elif url == "http://github/":
-                self.github()
-            elif url == "http://about2/":
-                self.more_info()
-            elif url == "http://deviceinfo/":
-                self.device_info()
+        try:
+            if url:
+                url = url.group(1)
+                if url == "http://about/":
+                    self.about()
+                elif url == "http://github/":
+                    self.github()
+                elif url == "http://about2/":
+                    self.more_info()
+                elif url == "http://deviceinfo/":
+                    self.device_info()
+                elif url == "http://metrics/":
+                    self.metrics_page()
+                elif url.startswith(DEFERRED_IMAGE_URL):
+                    self.deferred_image(url)
+                elif url.startswith(self.PROFILE_URL):
+                    self.profile_page(url[len(self.PROFILE_URL) :])
+                else:
+                    self.web_page(url)
+                status = "ok"
+
             else:
-                print(url)
-                response = requests.get(url, headers=self.REQUESTS_HEADER, timeout=5)
-                parser = XiinoHTMLParser(base_url=response.url)
-                print(response.url)
-                parser.feed(response.text)
-                clean_html = parser.get_parsed_data()
-                self.wfile.write(clean_html.encode("latin-1", errors="ignore"))
-
-        else:
+                self.wfile.write(
+                    "Invalid request! Please contact the devs.".encode("latin-1")
+                )
+                self.wfile.write(f"<br>Request: {self.requestline}".encode("latin-1"))
+                status = "invalid"
+        finally:
+            METRICS.record_request(self.timings)
+            self.log_message(
+                "url=%s status=%s %s", url, status, self.timings.log_fields()
+            )
+
+    def log_request(self, code="-", size="-"):
+        # do_GET logs one line per request, with its timings, instead
+        pass
+
+    def web_page(self, url: str):
+        "Fetch a page and stream it out converted, images and all."
+        try:
+            with self.timings.stage("page_fetch"):
+                response = http_client.get(
+                    url,
+                    headers=self.REQUESTS_HEADER,
+                    timeout=5,
+                    deadline=self.deadline,
+                    stream=True,
+                )
+        except requests.RequestException as error:
+            self.timings.count("page_errors")
             self.wfile.write(
-                "Invalid request! Please contact the devs.".encode("latin-1")
+                iso8859(
+                    "<HTML><TITLE>Page Unavailable</TITLE><BODY>"
+                    "<H1>Page Unavailable</H1>"
+                    f"<P>{html.escape(str(error))}</P></BODY></HTML>"
+                )
             )
-            self.wfile.write(f"<br>Request: {self.requestline}".encode("latin-1"))
+            return
+        parser = XiinoHTMLParser(
+            base_url=response.url,
+            image_pipeline=self.IMAGE_PIPELINE,
+            encoding_pool=self.ENCODING_POOL,
+            image_cache=self.IMAGE_CACHE,
+            mode9_engine=self.MODE9_ENGINE,
+            image_mode=self.IMAGE_MODE,
+            output=self.wfile,
+            device_profile=self.device_profile,
+            image_budget=self.IMAGE_BUDGET,
+            timings=self.timings,
+            deadline=self.deadline,
+            max_image_bytes=self.MAX_IMAGE_BYTES,
+            max_image_pixels=self.MAX_IMAGE_PIXELS,
+        )
+        page = http_client.iter_text(
+            response, self.MAX_PAGE_BYTES, deadline=self.deadline
+        )
+        try:
+            while True:
+                # the page downloads as it's parsed, so time the two separately
+                with self.timings.stage("page_download"):
+                    text = next(page, None)
+                if text is None:
+                    break
+                with self.timings.stage("parse"):
+                    parser.feed(text)
+        except requests.RequestException as error:
+            # part of the page is already out; finish it with what arrived,
+            # so its images and links are still sent
+            print(f"Warn: page download cut short at {url}: {error}")
+            self.timings.count("page_cut_short")
+        with self.timings.stage("finish"):
+            parser.close()
 
     def about(self):
         "Show the About screen."
@@ -75,27 +201,102 @@ class XiinoDataServer(BaseHTTPRequestHandler):
         "Show more info about OpenXiino."
         self.__internal_file_page_handler("about2.html")
 
+    def profile_page(self, url: str):
+        """
+        Convert a page under cProfile, save the stats to `PROFILE_DIR`,
+        and show the slowest functions instead of the page.
+        """
+        if not self.PROFILE_DIR:
+            self.wfile.write(
+                "Profiling is turned off on this server.".encode("latin-1")
+            )
+            return
+
+        # cProfile only sees this thread, so convert images here rather than
+        # on the pipeline or in the encoding processes, and skip the cache so
+        # every image is actually converted. These shadow the class-wide
+        # settings for this request only.
+        self.IMAGE_PIPELINE = ImagePipeline(max_workers=0)
+        self.ENCODING_POOL = None
+        self.IMAGE_CACHE = None
+
+        if not self.PROFILE_LOCK.acquire(blocking=False):
+            self.wfile.write(
+                "The profiler is busy with another page. Please try again "
+                "in a moment.".encode("latin-1")
+            )
+            return
+
+        device_output = self.wfile
+        converted = io.BytesIO()
+        self.wfile = converted
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.runcall(self.web_page, url)
+        finally:
+            self.wfile = device_output
+            self.PROFILE_LOCK.release()
+        elapsed = time.perf_counter() - started
+
+        host = urlsplit(url).hostname or "page"
+        stats_file = os.path.join(
+            self.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{host}.prof"
+        )
+        stats = pstats.Stats(profiler)
+        stats.dump_stats(stats_file)
+        self.log_message("profile of %s saved to %s", url, stats_file)
+
+        functions = sorted(
+            stats.stats.items(), key=lambda item: item[1][3], reverse=True
+        )
+        page = yattag.Doc()
+        with page.tag("html"):
+            page.line("title", "Profile")
+            with page.tag("body"):
+                page.line("h1", "Profile")
+                page.line(
+                    "p",
+                    f"{url} took {elapsed * 1000:.0f} ms "
+                    f"and came to {len(converted.getvalue())} bytes.",
+                )
+                page.line("p", f"Saved as {os.path.basename(stats_file)}")
+                with page.tag("table", border="1"):
+                    with page.tag("tr"):
+                        for heading in ("Function", "Calls", "Own ms", "Total ms"):
+                            page.line("th", heading)
+                    for (filename, line, function), stat in functions[:40]:
+                        _, calls, own_time, total_time, _ = stat
+                        with page.tag("tr"):
+                            page.line(
+                                "td",
+                                f"{function} ({os.path.basename(filename)}:{line})",
+                            )
+                            page.line("td", str(calls))
+                            page.line("td", f"{own_time * 1000:.1f}")
+                            page.line("td", f"{total_time * 1000:.1f}")
+
+        self.wfile.write(page.getvalue().encode("latin-1", errors="replace"))
+
     def device_info(self):
         "Show info about the device making the request."
-        colour_depth = self.COLOUR_DEPTH_REGEX.search(self.requestline)
-        gscale_depth = self.GSCALE_DEPTH_REGEX.search(self.requestline)
-        screen_width = self.SCREEN_WIDTH_REGEX.search(self.requestline)
-        txt_encoding = self.TXT_ENCODING_REGEX.search(self.requestline)
+        colour_depth = self.device_profile.colour_depth
+        gscale_depth = self.device_profile.greyscale_depth
+        screen_width = self.device_profile.screen_width
+        txt_encoding = self.device_profile.text_encoding
         infopage = yattag.Doc()
         with infopage.tag("html"):
             infopage.line("title", "Device Info")
             with infopage.tag("body"):
                 infopage.line("h1", "Device Info")
                 with infopage.tag("ul"):
-                    if colour_depth:
-                        depth = colour_depth.group(1)
+                    if colour_depth is not None:
                         with infopage.tag("li"):
-                            infopage.line("b", f"{depth}-bit colour ")
+                            infopage.line("b", f"{colour_depth}-bit colour ")
                             infopage.text("reported by Xiino.")
-                    elif gscale_depth:
-                        depth = gscale_depth.group(1)
+                    elif gscale_depth is not None:
                         with infopage.tag("li"):
-                            infopage.line("b", f"{depth}-bit grayscale ")
+                            infopage.line("b", f"{gscale_depth}-bit grayscale ")
                             infopage.text("reported by Xiino.")
                     else:
                         with infopage.tag("li"):
@@ -104,12 +305,11 @@ class XiinoDataServer(BaseHTTPRequestHandler):
                                 "Please tell the OpenXiino devs about your Xiino version."
                             )
 
-                    if screen_width:
-                        width = screen_width.group(1)
+                    if screen_width is not None:
                         with infopage.tag("li"):
-                            infopage.line("b", f"{width}px ")
+                            infopage.line("b", f"{screen_width}px ")
                             infopage.text("viewport reported by Xiino. ")
-                            if int(width) > 153:
+                            if screen_width > 153:
                                 infopage.text("This is a high-density device.")
                     else:
                         with infopage.tag("li"):
@@ -118,12 +318,11 @@ class XiinoDataServer(BaseHTTPRequestHandler):
                                 "Please tell the OpenXiino devs about your Xiino version."
                             )
 
-                    if txt_encoding:
-                        encoding = txt_encoding.group(1)
+                    if txt_encoding is not None:
                         with infopage.tag("li"):
                             infopage.text("Your text encoding is set to ")
                             infopage.stag("br")
-                            infopage.line("b", str(encoding))
+                            infopage.line("b", txt_encoding)
                     else:
                         with infopage.tag("li"):
                             infopage.text("Your device isn't reporting an encoding!")
@@ -136,6 +335,90 @@ class XiinoDataServer(BaseHTTPRequestHandler):
 
         self.wfile.write(infopage.getvalue().encode("latin-1", errors="replace"))
 
+    def metrics_page(self):
+        "Show where the server's time has gone, and how the image cache is doing."
+        counters, request_seconds, stage_seconds = METRICS.snapshot()
+        page = yattag.Doc()
+        with page.tag("html"):
+            page.line("title", "Server Metrics")
+            with page.tag("body"):
+                page.line("h1", "Server Metrics")
+                page.line("p", f"{request_seconds.count} requests.")
+                with page.tag("table", border="1"):
+                    with page.tag("tr"):
+                        for heading in ("Stage", "Requests", "Mean ms", "~p90 ms"):
+                            page.line("th", heading)
+                    rows = [("total", request_seconds)] + sorted(stage_seconds.items())
+                    for name, histogram in rows:
+                        if not histogram.count:
+                            continue
+                        with page.tag("tr"):
+                            page.line("td", name)
+                            page.line("td", str(histogram.count))
+                            page.line(
+                                "td", f"{histogram.sum / histogram.count * 1000:.1f}"
+                            )
+                            page.line("td", f"{histogram.quantile(0.9) * 1000:g}")
+
+                page.line("h2", "Counts")
+                with page.tag("ul"):
+                    for name, value in sorted(counters.items()):
+                        page.line("li", f"{name}: {format_number(value)}")
+
+                page.line("h2", "Image Cache")
+                with page.tag("ul"):
+                    for name, value in self.IMAGE_CACHE.stats().items():
+                        page.line("li", f"{name}: {value}")
+
+                page.line("h2", "Skipped Hosts")
+                page.line("p", ", ".join(http_client.breaker().open_hosts()) or "None.")
+
+        self.wfile.write(page.getvalue().encode("latin-1", errors="replace"))
+
+    def metrics_text(self):
+        "Send the server's metrics as plain text, for monitoring tools."
+        stats = self.IMAGE_CACHE.stats()
+        gauges = {
+            "image_cache_entries": stats.pop("entries"),
+            "image_cache_bytes": stats.pop("bytes"),
+            "upstream_hosts_skipped": len(http_client.breaker().open_hosts()),
+        }
+        counters = {f"image_cache_{name}": value for name, value in stats.items()}
+        if self.ENCODING_POOL is not None:
+            counters["encoder_pool_restarts"] = self.ENCODING_POOL.restarts
+        body = METRICS.text_format(counters, gauges).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def deferred_image(self, url: str):
+        "Show a single image that was left out of a page to keep it small."
+        source = parse_qs(urlsplit(url).query).get("src")
+        if not source:
+            self.wfile.write("Invalid image link!".encode("latin-1"))
+            return
+
+        self.wfile.write(iso8859("<HTML><TITLE>Image</TITLE><BODY>"))
+        parser = XiinoHTMLParser(
+            base_url=source[0],
+            image_pipeline=self.IMAGE_PIPELINE,
+            encoding_pool=self.ENCODING_POOL,
+            image_cache=self.IMAGE_CACHE,
+            mode9_engine=self.MODE9_ENGINE,
+            image_mode=self.IMAGE_MODE,
+            output=self.wfile,
+            device_profile=self.device_profile,
+            timings=self.timings,
+            deadline=self.deadline,
+            max_image_bytes=self.MAX_IMAGE_BYTES,
+            max_image_pixels=self.MAX_IMAGE_PIXELS,
+        )
+        parser.feed(f'<IMG SRC="{html.escape(source[0])}">')
+        parser.close()
+        self.wfile.write(iso8859("</BODY></HTML>"))
+
     def __internal_file_page_handler(self, filename: str):
         "Load a page from the server's own files."
         with open(filename, encoding="utf-8") as handle:
@@ -143,12 +426,217 @@ class XiinoDataServer(BaseHTTPRequestHandler):
 
 
 if __name__ == "__main__":
-    web_server = http.server.HTTPServer(("0.0.0.0", 4040), XiinoDataServer)
-    print("Dataserver running on port 4040")
+    arg_parser = argparse.ArgumentParser(description="OpenXiino dataserver")
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="number of requests served at the same time (default: 8)",
+    )
+    arg_parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=16,
+        help="requests allowed to wait for a free worker before clients "
+        "are sent a 'server busy' page; 0 sends it whenever no worker is "
+        "free (default: 16)",
+    )
+    arg_parser.add_argument(
+        "--image-workers",
+        type=int,
+        default=8,
+        help="page images fetched and converted at the same time, shared by "
+        "all requests (default: 8)",
+    )
+    arg_parser.add_argument(
+        "--image-per-host",
+        type=int,
+        default=4,
+        help="image fetches from any one upstream host at the same time "
+        "(default: 4)",
+    )
+    arg_parser.add_argument(
+        "--encoder-processes",
+        type=int,
+        default=os.cpu_count(),
+        help="worker processes for image encoding, or 0 to encode in the "
+        "request thread (default: one per CPU)",
+    )
+    arg_parser.add_argument(
+        "--image-cache-mb",
+        type=int,
+        default=32,
+        help="memory used to cache converted images, in MiB (default: 32)",
+    )
+    arg_parser.add_argument(
+        "--image-cache-max-age",
+        type=float,
+        default=300,
+        help="seconds a cached image is used before checking upstream "
+        "whether it has changed (default: 300)",
+    )
+    arg_parser.add_argument(
+        "--cache-file",
+        help="load converted images from this file at startup (e.g. made "
+        "by preconvert.py), and save the cache back to it on exit",
+    )
+    arg_parser.add_argument(
+        "--upstream-connections",
+        type=int,
+        default=8,
+        help="keep-alive connections kept open to each upstream host (default: 8)",
+    )
+    arg_parser.add_argument(
+        "--upstream-retries",
+        type=int,
+        default=2,
+        help="retries for failed upstream connections and 502/503/504 "
+        "responses (default: 2)",
+    )
+    arg_parser.add_argument(
+        "--mode9-engine",
+        choices=mode9.ENGINES,
+        default="numpy",
+        help="mode 9 encoder: 'optimal' makes the smallest images but is "
+        "slower, 'auto' uses it for small images only (default: numpy)",
+    )
+    arg_parser.add_argument(
+        "--image-mode",
+        choices=("auto", "compressed"),
+        default="auto",
+        help="'auto' encodes each image both compressed and uncompressed and "
+        "sends the smaller; 'compressed' always compresses (default: auto)",
+    )
+    arg_parser.add_argument(
+        "--max-page-kb",
+        type=int,
+        default=1024,
+        help="read at most this much of an upstream page, in KiB; the rest "
+        "is dropped (default: 1024)",
+    )
+    arg_parser.add_argument(
+        "--max-page-images",
+        type=int,
+        default=40,
+        help="images inlined per page before the rest become links (default: 40)",
+    )
+    arg_parser.add_argument(
+        "--max-page-image-kb",
+        type=int,
+        default=192,
+        help="image data inlined per page before the rest become links, "
+        "in KiB (default: 192)",
+    )
+    arg_parser.add_argument(
+        "--max-page-image-seconds",
+        type=float,
+        default=15,
+        help="time spent on a page's images before the rest become links "
+        "(default: 15)",
+    )
+    arg_parser.add_argument(
+        "--max-image-kb",
+        type=int,
+        default=4096,
+        help="skip images bigger than this, in KiB; they are only "
+        "downloaded up to this size (default: 4096)",
+    )
+    arg_parser.add_argument(
+        "--max-image-megapixels",
+        type=float,
+        default=25,
+        help="skip images with more pixels than this, checked before "
+        "they are decoded (default: 25)",
+    )
+    arg_parser.add_argument(
+        "--page-deadline",
+        type=float,
+        default=20,
+        help="seconds allowed for a whole page, images included; images "
+        "not ready by then become links (default: 20)",
+    )
+    arg_parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        default=3,
+        help="timeouts or connection failures in a row before an upstream "
+        "host is skipped for a while (default: 3)",
+    )
+    arg_parser.add_argument(
+        "--breaker-reset",
+        type=float,
+        default=30,
+        help="seconds a failing upstream host is skipped for (default: 30)",
+    )
+    arg_parser.add_argument(
+        "--profile-dir",
+        help="turn on http://profile/?<url>, which converts a page under "
+        "cProfile, shows the slowest functions and saves the stats here "
+        "(default: off)",
+    )
+    args = arg_parser.parse_args()
+
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+        XiinoDataServer.PROFILE_DIR = args.profile_dir
+
+    XiinoDataServer.IMAGE_BUDGET = ImageBudget(
+        max_images=args.max_page_images,
+        max_bytes=args.max_page_image_kb * 1024,
+        max_seconds=args.max_page_image_seconds,
+    )
+
+    XiinoDataServer.MAX_PAGE_BYTES = args.max_page_kb * 1024
+    XiinoDataServer.PAGE_DEADLINE_SECONDS = args.page_deadline
+    XiinoDataServer.MAX_IMAGE_BYTES = args.max_image_kb * 1024
+    XiinoDataServer.MAX_IMAGE_PIXELS = int(args.max_image_megapixels * 1_000_000)
+
+    XiinoDataServer.IMAGE_PIPELINE = ImagePipeline(
+        max_workers=args.image_workers, per_host_limit=args.image_per_host
+    )
+    XiinoDataServer.MODE9_ENGINE = args.mode9_engine
+    XiinoDataServer.IMAGE_MODE = args.image_mode
+
+    http_client.configure(
+        per_host_connections=args.upstream_connections,
+        retries=args.upstream_retries,
+        breaker_failures=args.breaker_failures,
+        breaker_reset_seconds=args.breaker_reset,
+    )
+
+    XiinoDataServer.IMAGE_CACHE = ImageCache(
+        max_bytes=args.image_cache_mb * 1024 * 1024,
+        max_age=args.image_cache_max_age,
+    )
+    if args.cache_file and os.path.exists(args.cache_file):
+        loaded = XiinoDataServer.IMAGE_CACHE.load(args.cache_file)
+        print(f"Loaded {loaded} converted images from {args.cache_file}")
+
+    if args.encoder_processes > 0:
+        XiinoDataServer.ENCODING_POOL = EncodingPool(processes=args.encoder_processes)
+
+    web_server = PooledHTTPServer(
+        ("0.0.0.0", 4040),
+        XiinoDataServer,
+        workers=args.workers,
+        queue_depth=args.queue_depth,
+        busy_response=busy_response(),
+    )
+    print(f"Dataserver running on port 4040 with {args.workers} workers")
+
+    def stop(_signum, _frame):
+        raise KeyboardInterrupt
+
+    # shut down tidily (saving the cache file) when stopped by a service manager
+    signal.signal(signal.SIGTERM, stop)
     try:
         web_server.serve_forever()
     except KeyboardInterrupt:
         pass
 
     web_server.server_close()
+    if args.cache_file:
+        XiinoDataServer.IMAGE_CACHE.save(args.cache_file)
+    if XiinoDataServer.ENCODING_POOL is not None:
+        XiinoDataServer.ENCODING_POOL.shutdown()
     print("Dataserver stopped.")
@@ -0,0 +1,86 @@
+"What the requesting device can display, as reported by Xiino."
+import re
+from dataclasses import dataclass
+
+COLOUR_DEPTH_REGEX = re.compile(r"\/c([0-9]*)\/")
+GSCALE_DEPTH_REGEX = re.compile(r"\/g([0-9]*)\/")
+SCREEN_WIDTH_REGEX = re.compile(r"\/w([0-9]*)\/")
+TXT_ENCODING_REGEX = re.compile(r"\/[de]{1,2}([a-zA-Z0-9-]*)\/")
+
+# Viewport width of a standard (160px) Palm screen.
+STANDARD_WIDTH = 153
+
+
+def _search_int(regex: re.Pattern, string: str) -> int | None:
+    match = regex.search(string)
+    if match and match.group(1):
+        return int(match.group(1))
+    return None
+
+
+@dataclass(frozen=True)
+class DeviceProfile:
+    """
+    The display capabilities Xiino puts in the request line,
+    e.g. `GET /c8/w153/?http://example.com/ HTTP/1.0`.
+    Anything the device didn't report is None.
+    """
+
+    colour_depth: int | None = None
+    greyscale_depth: int | None = None
+    screen_width: int | None = None
+    text_encoding: str | None = None
+
+    @classmethod
+    def from_request_line(cls, request_line: str) -> "DeviceProfile":
+        "Parse a profile from an HTTP request line."
+        txt_encoding = TXT_ENCODING_REGEX.search(request_line)
+        return cls(
+            colour_depth=_search_int(COLOUR_DEPTH_REGEX, request_line),
+            greyscale_depth=_search_int(GSCALE_DEPTH_REGEX, request_line),
+            screen_width=_search_int(SCREEN_WIDTH_REGEX, request_line),
+            text_encoding=txt_encoding.group(1) if txt_encoding else None,
+        )
+
+    def conversion(self) -> tuple[str, dict]:
+        """
+        The `EBDConverter` method (and its arguments) that makes the best
+        image this device can show. Devices that don't report a depth,
+        and all colour devices, get 8-bit colour.
+        """
+        if self.colour_depth is None and self.greyscale_depth is not None:
+            if self.greyscale_depth <= 1:
+                return "convert_bw", {"compressed": True}
+            if self.greyscale_depth == 2:
+                return "convert_gs", {"depth": 2, "compressed": True}
+            return "convert_gs", {"depth": 4, "compressed": True}
+        return "convert_colour", {"compressed": True}
+
+    def conversions(self) -> list[tuple[str, dict]]:
+        """
+        The `EBDConverter` methods (and arguments) for every mode this
+        device can show at its best depth: `conversion` first, then the
+        same thing uncompressed, which is smaller for some images.
+        """
+        method, kwargs = self.conversion()
+        return [(method, kwargs), (method, kwargs | {"compressed": False})]
+
+    @property
+    def image_width(self) -> int:
+        """
+        The widest image to send. High-density devices report a wider
+        viewport than the standard 153px, and get bigger images to match.
+        """
+        if self.screen_width is None or self.screen_width < 16:
+            return STANDARD_WIDTH
+        return self.screen_width
+
+    @property
+    def ebd_mode(self) -> int:
+        "The EBD mode `conversion` produces."
+        method, kwargs = self.conversion()
+        if method == "convert_bw":
+            return 1
+        if method == "convert_gs":
+            return 3 if kwargs["depth"] == 2 else 5
+        return 9
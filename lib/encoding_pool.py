@@ -0,0 +1,96 @@
+"Run CPU-bound EBD encoding in worker processes, away from the GIL."
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import PIL.Image
+from lib.xiino_image_converter import EBDConverter, EBDImage
+from lib.xiino_palette_common import PALETTE_IMAGE
+
+ENCODE_METHODS = ("convert_bw", "convert_gs", "convert_colour", "convert_smallest")
+
+
+def _warm_up():
+    "Worker initializer: load the palette once, before the first job arrives."
+    PALETTE_IMAGE.load()
+
+
+def _encode(size: tuple[int, int], rgb_data: bytes, method: str, kwargs: dict):
+    "Worker side of `EncodingPool.encode`."
+    image = PIL.Image.frombytes("RGB", size, rgb_data)
+    converter = EBDConverter(image, override_scale_logic=True)
+    return getattr(converter, method)(**kwargs)
+
+
+class EncodingPool:
+    """
+    Encode already-resized images in a pool of worker processes.
+
+    Only the raw RGB bytes and the size are sent to the workers, and an
+    `EBDImage` comes back. Images smaller than `min_pixels` are encoded
+    in-process, since pickling them costs more than encoding them.
+
+    If a worker dies (e.g. killed for running out of memory), the pool is
+    replaced with a new one, and the image it was on is encoded in-process.
+
+    :param processes: Number of worker processes. Defaults to the CPU count.
+    :param min_pixels: Smallest image (width * height) sent to the pool.
+    """
+
+    def __init__(self, processes: int | None = None, min_pixels: int = 4096) -> None:
+        self.min_pixels = min_pixels
+        self.processes = processes
+        self.restarts = 0
+        self.__executor = self.__new_executor()
+        self.__lock = threading.Lock()
+
+    def __new_executor(self) -> ProcessPoolExecutor:
+        # spawn rather than fork: forking a process full of server threads
+        # can leave locks held in the child
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_up,
+        )
+
+    def encode(self, image: PIL.Image.Image, method: str, **kwargs) -> EBDImage:
+        """
+        Encode an RGB image that has already been scaled by `EBDConverter`.
+        Blocks until the result is ready.
+
+        :param image: The converter's `image`.
+        :param method: One of `ENCODE_METHODS`, e.g. "convert_colour".
+        :param kwargs: Passed on to the conversion method.
+        """
+        if method not in ENCODE_METHODS:
+            raise ValueError(f"Unknown encode method {method}")
+
+        if image.width * image.height < self.min_pixels:
+            converter = EBDConverter(image, override_scale_logic=True)
+            return getattr(converter, method)(**kwargs)
+
+        executor = self.__executor
+        try:
+            return executor.submit(
+                _encode, image.size, image.convert("RGB").tobytes(), method, kwargs
+            ).result()
+        except BrokenProcessPool:
+            self.__replace(executor)
+            converter = EBDConverter(image, override_scale_logic=True)
+            return getattr(converter, method)(**kwargs)
+
+    def __replace(self, broken: ProcessPoolExecutor) -> None:
+        "Swap a broken executor for a new one, unless another thread just did."
+        with self.__lock:
+            if self.__executor is not broken:
+                return
+            print("Warn: an encoder process died, starting a new pool")
+            self.__executor = self.__new_executor()
+            self.restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait: bool = True) -> None:
+        "Stop the worker processes."
+        with self.__lock:
+            executor = self.__executor
+        executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,288 @@
+"Process-wide pooled HTTP client for upstream fetches."
+import codecs
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import urllib3.exceptions
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HostUnavailable(requests.ConnectionError):
+    "The circuit breaker is open for this host, so it wasn't contacted."
+
+
+class DeadlineExceeded(requests.Timeout):
+    "The request's deadline passed before this fetch could start."
+
+
+class ResponseTooLarge(requests.RequestException):
+    "A response's body is bigger than the caller allows."
+
+
+class CircuitBreaker:
+    """
+    Stop fetching from hosts that keep timing out or refusing connections.
+
+    After `failures` of those in a row, a host is skipped for `reset_seconds`.
+    Then one fetch is let through as a trial: if it works the host is back,
+    if it fails the host is skipped again.
+
+    :param failures: Failures in a row before a host is skipped.
+    :param reset_seconds: How long a host is skipped for.
+    """
+
+    def __init__(self, failures: int = 3, reset_seconds: float = 30) -> None:
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        # host -> (failures in a row, when it was last skipped or trialled)
+        self.__hosts: dict[str, tuple[int, float | None]] = {}
+        self.__lock = threading.Lock()
+
+    def allow(self, url: str) -> bool:
+        "Can `url` be fetched? Lets one trial through once a host's wait is up."
+        host = urlsplit(url).netloc.lower()
+        with self.__lock:
+            failures, opened = self.__hosts.get(host, (0, None))
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.reset_seconds:
+                return False
+            # restart the clock, so only this one fetch is let through
+            self.__hosts[host] = (failures, time.monotonic())
+            return True
+
+    def record_success(self, url: str) -> None:
+        "A fetch from this host worked, so it's healthy."
+        with self.__lock:
+            self.__hosts.pop(urlsplit(url).netloc.lower(), None)
+
+    def record_failure(self, url: str) -> None:
+        "A fetch from this host timed out or couldn't connect."
+        host = urlsplit(url).netloc.lower()
+        with self.__lock:
+            failures, opened = self.__hosts.get(host, (0, None))
+            failures += 1
+            if failures >= self.failures:
+                opened = time.monotonic()
+            self.__hosts[host] = (failures, opened)
+
+    def open_hosts(self) -> list[str]:
+        "Hosts being skipped right now."
+        now = time.monotonic()
+        with self.__lock:
+            return [
+                host
+                for host, (_, opened) in self.__hosts.items()
+                if opened is not None and now - opened < self.reset_seconds
+            ]
+
+
+__session: requests.Session | None = None
+__session_lock = threading.Lock()
+__breaker = CircuitBreaker()
+
+
+def configure(
+    *,
+    per_host_connections: int = 8,
+    host_pools: int = 32,
+    retries: int = 2,
+    backoff_factor: float = 0.2,
+    breaker_failures: int = 3,
+    breaker_reset_seconds: float = 30,
+    install_session: bool = True,
+) -> requests.Session:
+    """
+    (Re)create the shared session used for page and image fetches.
+
+    Connections are kept alive and reused, so an image-heavy page only pays
+    for a handful of TCP/TLS handshakes per host.
+
+    :param per_host_connections: Connections kept open to each host.
+        Fetches past this wait for a free connection rather than opening
+        (and then throwing away) extra ones.
+    :param host_pools: Number of hosts to keep connection pools for.
+    :param retries: Retries on connection errors and 502/503/504 responses.
+    :param backoff_factor: Delay between retries, see urllib3's `Retry`.
+    :param breaker_failures: See `CircuitBreaker`.
+    :param breaker_reset_seconds: See `CircuitBreaker`.
+    :param install_session: If False, just build and return a new session,
+        and leave the circuit breaker alone.
+    """
+    global __session, __breaker  # pylint: disable=global-statement
+
+    retry = Retry(
+        total=retries,
+        read=0,  # a slow read has already cost us the timeout, don't repeat it
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        backoff_factor=backoff_factor,
+        # a Retry-After can be hours, far past any timeout or page deadline
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=host_pools,
+        pool_maxsize=per_host_connections,
+        pool_block=True,
+        max_retries=retry,
+    )
+    new_session = requests.Session()
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    if not install_session:
+        return new_session
+    with __session_lock:
+        old_session, __session = __session, new_session
+        __breaker = CircuitBreaker(breaker_failures, breaker_reset_seconds)
+    if old_session is not None:
+        old_session.close()
+    return new_session
+
+
+def session() -> requests.Session:
+    "Get the shared session, creating it with default settings if needed."
+    global __session  # pylint: disable=global-statement
+
+    with __session_lock:
+        if __session is None:
+            __session = configure(install_session=False)
+        return __session
+
+
+def breaker() -> CircuitBreaker:
+    "Get the shared circuit breaker."
+    return __breaker
+
+
+def get(
+    url: str, *, timeout: float = 5, deadline: float | None = None, **kwargs
+) -> requests.Response:
+    """
+    GET with the shared session, through the circuit breaker.
+
+    :param timeout: Connect and read timeout, in seconds.
+    :param deadline: `time.monotonic()` time by which the whole request
+        should be done; the timeout is cut short to fit. Raises
+        `DeadlineExceeded` if it has already passed.
+    :param kwargs: Passed on to `requests.Session.get`.
+    :raises HostUnavailable: if the host is being skipped.
+    """
+    if not __breaker.allow(url):
+        raise HostUnavailable(f"Skipping {urlsplit(url).netloc} for now")
+
+    full_timeout = True
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No time left to fetch {url}")
+        if remaining < timeout:
+            timeout = remaining
+            full_timeout = False
+
+    try:
+        response = session().get(url, timeout=timeout, **kwargs)
+    except (requests.Timeout, requests.ConnectionError):
+        # only count it against the host if it had the full timeout
+        if full_timeout:
+            __breaker.record_failure(url)
+        raise
+    __breaker.record_success(url)
+    return response
+
+
+def read_limited(
+    response: requests.Response, max_bytes: int | None, chunk_size: int = 65536
+) -> bytes:
+    """
+    Read the body of a streamed (`stream=True`) response, up to `max_bytes`.
+
+    Raises `ResponseTooLarge` as soon as the body is known to be too big:
+    before reading anything if Content-Length says so, otherwise once that
+    much has arrived. This also catches bodies that only get too big once
+    they are decompressed. The response is closed either way.
+    """
+    try:
+        if max_bytes is None:
+            return response.content
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > max_bytes:
+            raise ResponseTooLarge(f"{response.url} is {length} bytes")
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            body += chunk
+            if len(body) > max_bytes:
+                raise ResponseTooLarge(f"{response.url} is over {max_bytes} bytes")
+        return bytes(body)
+    finally:
+        response.close()
+
+
+def iter_text(
+    response: requests.Response,
+    max_bytes: int,
+    chunk_size: int = 16384,
+    deadline: float | None = None,
+):
+    """
+    Decode a streamed (`stream=True`) response piece by piece.
+
+    Stops after `max_bytes` of body have been read and drops the rest,
+    and likewise once the `time.monotonic()` time `deadline` has passed.
+    The charset comes from the response headers; if there isn't one,
+    UTF-8 is assumed, as guessing would need the whole body.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(
+            errors="replace"
+        )
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    remaining = max_bytes
+    try:
+        for chunk in _iter_arrived(response, chunk_size):
+            if len(chunk) >= remaining:
+                yield decoder.decode(chunk[:remaining], final=True)
+                return
+            remaining -= len(chunk)
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+            if deadline is not None and time.monotonic() >= deadline:
+                yield decoder.decode(b"", final=True)
+                return
+        yield decoder.decode(b"", final=True)
+    finally:
+        response.close()
+
+
+def _iter_arrived(response: requests.Response, chunk_size: int):
+    """
+    Body chunks of up to `chunk_size`, as soon as they arrive.
+    `iter_content` waits for a whole chunk, so when an upstream stalls or
+    drops the connection partway, it loses what had already arrived.
+    Errors are raised as the `requests` exceptions `iter_content` uses.
+    """
+    raw = response.raw
+    if not hasattr(raw, "read1"):
+        # urllib3 1.x
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    try:
+        while True:
+            chunk = raw.read1(chunk_size, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    except urllib3.exceptions.ProtocolError as error:
+        raise requests.exceptions.ChunkedEncodingError(error) from error
+    except urllib3.exceptions.DecodeError as error:
+        raise requests.exceptions.ContentDecodingError(error) from error
+    except urllib3.exceptions.ReadTimeoutError as error:
+        raise requests.ConnectionError(error) from error
+    except urllib3.exceptions.SSLError as error:
+        raise requests.exceptions.SSLError(error) from error
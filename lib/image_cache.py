@@ -0,0 +1,188 @@
+"In-memory LRU cache of converted EBD images."
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from lib.xiino_image_converter import EBDImage
+
+# Bumped whenever the layout written by `ImageCache.save` changes.
+CACHE_FILE_VERSION = 1
+
+
+@dataclass
+class CacheEntry:
+    """
+    A converted image, plus what we need to revalidate it upstream.
+    """
+
+    image: EBDImage
+    etag: str | None = None
+    last_modified: str | None = None
+    stored_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def size(self) -> int:
+        "Approximate memory used by this entry, in bytes."
+        return len(self.image.raw_data)
+
+    def conditional_headers(self) -> dict[str, str]:
+        "Headers asking upstream to reply 304 if the image hasn't changed."
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ImageCache:
+    """
+    Size-bounded LRU cache of `EBDImage`s, keyed by
+    (absolute image URL, EBD mode, target width).
+
+    Entries older than `max_age` seconds are still returned, but marked
+    stale so the caller can revalidate them with `conditional_headers`.
+
+    :param max_bytes: Total EBD data kept before least recently used
+        entries are evicted.
+    :param max_age: Seconds an entry is used without revalidating it.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_age: float = 300) -> None:
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self.__entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, mode: int, width: int) -> tuple:
+        "Build a cache key."
+        return (url, mode, width)
+
+    def lookup(self, key: tuple) -> tuple[CacheEntry | None, bool]:
+        """
+        Find an entry. Returns `(entry, fresh)`; `entry` is None on a miss,
+        and `fresh` is False if the entry needs revalidating before use.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self.__entries.move_to_end(key)
+            if time.monotonic() - entry.stored_at > self.max_age:
+                self.stale += 1
+                return entry, False
+            self.hits += 1
+            return entry, True
+
+    def store(
+        self,
+        key: tuple,
+        image: EBDImage,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        age: float = 0,
+    ) -> None:
+        """
+        Add or replace an entry, evicting old ones to stay under `max_bytes`.
+
+        :param age: Seconds since the image was fetched, if not just now.
+        """
+        entry = CacheEntry(
+            image,
+            etag=etag,
+            last_modified=last_modified,
+            stored_at=time.monotonic() - age,
+        )
+        if entry.size > self.max_bytes:
+            return
+        with self.__lock:
+            old_entry = self.__entries.pop(key, None)
+            if old_entry is not None:
+                self.__size -= old_entry.size
+            self.__entries[key] = entry
+            self.__size += entry.size
+            while self.__size > self.max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= evicted.size
+                self.evictions += 1
+
+    def mark_not_modified(self, key: tuple) -> None:
+        "Upstream replied 304: the entry is good for another `max_age`."
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry.stored_at = time.monotonic()
+                self.revalidated += 1
+
+    def entries(self) -> list[tuple[tuple, CacheEntry]]:
+        "All `(key, entry)` pairs, least recently used first."
+        with self.__lock:
+            return list(self.__entries.items())
+
+    def save(self, path: str) -> None:
+        """
+        Write every entry to a file, for `load` to read back, e.g. when the
+        dataserver restarts. Entries keep their age, so stale ones are
+        still revalidated after loading.
+        """
+        now = time.monotonic()
+        state = {
+            "version": CACHE_FILE_VERSION,
+            "saved_at": time.time(),
+            "entries": [
+                (
+                    key,
+                    entry.image,
+                    entry.etag,
+                    entry.last_modified,
+                    now - entry.stored_at,
+                )
+                for key, entry in self.entries()
+            ],
+        }
+        # write and rename, so a crash can't leave half a file behind
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def load(self, path: str) -> int:
+        """
+        Add the entries saved in a file by `save`, returning how many.
+        The file is unpickled, so only load files you wrote yourself.
+        """
+        with open(path, "rb") as handle:
+            state = pickle.load(handle)
+        if state.get("version") != CACHE_FILE_VERSION:
+            raise ValueError(f"{path} isn't an image cache file this version can read")
+
+        # time since the file was written counts towards each entry's age
+        offline = max(time.time() - state["saved_at"], 0)
+        for key, image, etag, last_modified, age in state["entries"]:
+            self.store(
+                key, image, etag=etag, last_modified=last_modified, age=age + offline
+            )
+        return len(state["entries"])
+
+    def stats(self) -> dict[str, int]:
+        "Counters and current size, for display."
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "revalidated": self.revalidated,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,95 @@
+"Bounded, concurrent fetch-and-convert pipeline for page images."
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+
+@dataclass
+class ImageBudget:
+    """
+    Limits on the images inlined into one page. Images past a limit are
+    replaced by a link that loads them on their own. None means no limit.
+
+    :param max_images: Most images inlined per page.
+    :param max_bytes: Most EBD data inlined per page.
+    :param max_seconds: Longest time spent on a page's images,
+        counted from the first image found.
+    """
+
+    max_images: int | None = None
+    max_bytes: int | None = None
+    max_seconds: float | None = None
+
+
+class ImagePipeline:
+    """
+    Run image fetch + EBD conversion jobs on a fixed pool of worker threads.
+
+    The parser submits one job per `<IMG>` while it tokenizes the page and
+    keeps the returned `Future` as a placeholder, so images are resolved in
+    parallel and spliced back into the output in document order.
+
+    :param max_workers: Maximum number of images processed at once.
+        0 runs each job in the thread that submits it, before `submit`
+        returns, e.g. so a profiler on that thread sees the work.
+    :param per_host_limit: Maximum number of concurrent fetches to one host.
+    """
+
+    def __init__(self, max_workers: int = 8, per_host_limit: int = 4) -> None:
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.__executor = None
+        if max_workers > 0:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="xiino-image"
+            )
+        self.__host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self.__host_lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        "Queue a job on the pipeline's worker pool."
+        if self.__executor is not None:
+            return self.__executor.submit(function, *args, **kwargs)
+
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as exception:  # pylint: disable=broad-except
+            future.set_exception(exception)
+        return future
+
+    @contextmanager
+    def host_slot(self, url: str):
+        """
+        Hold one of the per-host fetch slots for the host of `url`.
+        Use this around the network part of a job only, so a slow host
+        doesn't also stall the conversion of images that are already here.
+        """
+        host = urlsplit(url).netloc.lower()
+        with self.__host_lock:
+            semaphore = self.__host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host_limit)
+                self.__host_semaphores[host] = semaphore
+        with semaphore:
+            yield
+
+    def shutdown(self, wait: bool = True) -> None:
+        "Stop accepting jobs and release the worker threads."
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+__default_pipeline: ImagePipeline | None = None
+__default_pipeline_lock = threading.Lock()
+
+
+def default_pipeline() -> ImagePipeline:
+    "Get the process-wide pipeline used when a parser isn't given one."
+    global __default_pipeline  # pylint: disable=global-statement
+    with __default_pipeline_lock:
+        if __default_pipeline is None:
+            __default_pipeline = ImagePipeline()
+        return __default_pipeline
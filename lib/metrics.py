@@ -0,0 +1,210 @@
+"Per-request stage timings, and server-wide counters and histograms."
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class RequestTimings:
+    """
+    Time spent in each stage of one request, plus a few counts.
+
+    Image stages run on several threads at once, so their totals add up
+    the time spent on every image, and can be more than the request took.
+    Stages can also nest: "parse" includes any "write" done while parsing.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.stages: dict[str, float] = defaultdict(float)
+        self.counts: dict[str, int] = defaultdict(int)
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        "Time the body of a `with` block as part of stage `name`."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        "Add time to a stage."
+        with self.__lock:
+            self.stages[name] += seconds
+
+    def count(self, name: str, amount: int = 1) -> None:
+        "Add to a count."
+        with self.__lock:
+            self.counts[name] += amount
+
+    def snapshot(self) -> tuple[dict[str, float], dict[str, int]]:
+        """
+        Copies of the stage times and counts. Image jobs that outlive the
+        request can still be adding to them, so read them through this.
+        """
+        with self.__lock:
+            return dict(self.stages), dict(self.counts)
+
+    @property
+    def elapsed(self) -> float:
+        "Seconds since the request started."
+        return time.monotonic() - self.started
+
+    def log_fields(self) -> str:
+        "The timings as `key=value` pairs for a log line."
+        stages, counts = self.snapshot()
+        fields = [f"total_ms={self.elapsed * 1000:.1f}"]
+        fields += [f"{name}_ms={value * 1000:.1f}" for name, value in stages.items()]
+        fields += [f"{name}={value}" for name, value in counts.items()]
+        return " ".join(fields)
+
+
+@contextmanager
+def stage(timings: RequestTimings | None, name: str):
+    "`timings.stage(name)`, or nothing if there are no timings to add to."
+    if timings is None:
+        yield
+    else:
+        with timings.stage(name):
+            yield
+
+
+class Histogram:
+    "Counts of observed values, by bucket, as in Prometheus."
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        "Record one value."
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+
+    def quantile(self, fraction: float) -> float:
+        "Estimate a quantile as the upper bound of the bucket it falls in."
+        target = fraction * self.count
+        seen = 0
+        for index, bound in enumerate(BUCKETS):
+            seen += self.buckets[index]
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Server-wide totals, built up from each request's `RequestTimings`.
+    """
+
+    def __init__(self) -> None:
+        self.counters: dict[str, float] = defaultdict(float)
+        self.request_seconds = Histogram()
+        self.stage_seconds: dict[str, Histogram] = defaultdict(Histogram)
+        self.__lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1) -> None:
+        "Add to a counter."
+        with self.__lock:
+            self.counters[name] += amount
+
+    def record_request(self, timings: RequestTimings) -> None:
+        "Add a finished request's timings and counts to the totals."
+        elapsed = timings.elapsed
+        stages, counts = timings.snapshot()
+        with self.__lock:
+            self.counters["requests"] += 1
+            self.request_seconds.observe(elapsed)
+            for name, seconds in stages.items():
+                self.stage_seconds[name].observe(seconds)
+            for name, amount in counts.items():
+                self.counters[name] += amount
+
+    def snapshot(self) -> tuple[dict, Histogram, dict]:
+        "Copies of the counters, request histogram and stage histograms."
+        with self.__lock:
+            return (
+                dict(self.counters),
+                _copy_histogram(self.request_seconds),
+                {
+                    name: _copy_histogram(hist)
+                    for name, hist in self.stage_seconds.items()
+                },
+            )
+
+    def text_format(
+        self,
+        extra_counters: dict[str, float] | None = None,
+        extra_gauges: dict[str, float] | None = None,
+    ) -> str:
+        """
+        All metrics, in the Prometheus text exposition format.
+
+        :param extra_counters: Totals kept elsewhere, e.g. by the image cache.
+        :param extra_gauges: Current values, e.g. the image cache's size.
+        """
+        counters, request_seconds, stage_seconds = self.snapshot()
+        counters |= extra_counters or {}
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE xiino_{name}_total counter")
+            lines.append(f"xiino_{name}_total {format_number(value)}")
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines.append(f"# TYPE xiino_{name} gauge")
+            lines.append(f"xiino_{name} {format_number(value)}")
+
+        lines.append("# TYPE xiino_request_seconds histogram")
+        lines.extend(_histogram_lines("xiino_request_seconds", "", request_seconds))
+        lines.append("# TYPE xiino_stage_seconds histogram")
+        for name, histogram in sorted(stage_seconds.items()):
+            lines.extend(
+                _histogram_lines("xiino_stage_seconds", f'stage="{name}"', histogram)
+            )
+        return "\n".join(lines) + "\n"
+
+
+def format_number(value: float) -> str:
+    """
+    A metric value in full: whole numbers as integers, anything else with
+    every digit. (":g" would round big totals to 6 digits, so they'd
+    stop changing between scrapes.)
+    """
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _copy_histogram(histogram: Histogram) -> Histogram:
+    copy = Histogram()
+    copy.buckets = list(histogram.buckets)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    return copy
+
+
+def _histogram_lines(name: str, labels: str, histogram: Histogram) -> list[str]:
+    separator = "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+    label_block = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{label_block} {format_number(histogram.sum)}")
+    lines.append(f"{name}_count{label_block} {histogram.count}")
+    return lines
+
+
+# Shared by the whole dataserver process.
+METRICS = Metrics()
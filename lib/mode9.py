@@ -1,17 +1,59 @@
 "Compress a PIL image using Xiino mode 9."
+import numpy as np
 import PIL.Image
 from lib.ebd_control_codes import CONTROL_CODES
-from lib.xiino_palette_common import PALETTE
+from lib.metrics import RequestTimings, stage
+from lib.xiino_palette_common import quantise
 
-xiino_palette = PIL.Image.open("lib/paletised.png")
+ENGINES = ("numpy", "python", "optimal", "auto")
 
+# "auto" uses the optimal encoder for images up to this many pixels.
+AUTO_OPTIMAL_MAX_PIXELS = 153 * 64
 
-def compress_mode9(image: PIL.Image.Image):
-    image = image.quantize(palette=xiino_palette).convert(
-        "RGB"
-    )  # quantise and then un-quantise
+# Longest run a single code can cover: 6, plus a 255 extension byte.
+_MAX_RUN = 6 + 0xFF
 
-    data = list(image.getdata())
+
+def compress_mode9(
+    image: PIL.Image.Image,
+    engine: str = "numpy",
+    timings: RequestTimings | None = None,
+    data: bytes | None = None,
+):
+    """
+    Compress an image with mode 9.
+
+    :param engine: "numpy" for the array-based encoder, or "python" for the
+        original line-by-line one; both produce identical output.
+        "optimal" finds the smallest encoding of each row, which is slower.
+        "auto" uses "optimal" for images up to `AUTO_OPTIMAL_MAX_PIXELS`,
+        and "numpy" for anything bigger.
+    :param timings: If given, time spent quantising and compressing is
+        added to its "quantise" and "mode9" stages.
+    :param data: The image's palette indices, if it's already quantised.
+    """
+    if data is None:
+        with stage(timings, "quantise"):
+            data = quantise(image)
+    with stage(timings, "mode9"):
+        return _compress(image, data, engine)
+
+
+def _compress(image: PIL.Image.Image, data: bytes, engine: str) -> bytes:
+    "Compress already quantised image data with the given engine."
+    if engine == "auto":
+        if image.width * image.height <= AUTO_OPTIMAL_MAX_PIXELS:
+            engine = "optimal"
+        else:
+            engine = "numpy"
+    if engine == "numpy":
+        return compress_mode9_numpy(image, data)
+    if engine == "optimal":
+        return compress_mode9_optimal(image, data)
+    if engine != "python":
+        raise ValueError(f"Unknown mode 9 engine {engine}")
+
+    # work on palette indices directly, one byte per pixel
     rows = []
     buffer = bytearray()
     for y in range(0, image.height):
@@ -26,7 +68,7 @@ def compress_mode9(image: PIL.Image.Image):
     return bytes(buffer)
 
 
-def compress_line(line: list, prev_line: list | None, first_line: bool):
+def compress_line(line: bytes, prev_line: bytes | None, first_line: bool):
     active_colour = 0x00
     buffer = bytearray()
 
@@ -47,8 +89,10 @@ def compress_line(line: list, prev_line: list | None, first_line: bool):
             # calculate all 3 and see which one saves the most space
 
             # see how much can be copied from previous line, offset -1
+            # (not at the start of the line, there's nothing before it)
             while (
-                index + lb_copy_length_a < len(line)
+                index > 0
+                and index + lb_copy_length_a < len(line)
                 and line[index + lb_copy_length_a]
                 == prev_line[(index - 1) + lb_copy_length_a]
             ):
@@ -105,6 +149,12 @@ def compress_line(line: list, prev_line: list | None, first_line: bool):
             ):
                 rle_length += 1
 
+        # longer runs than one code can cover carry on with the next code
+        rle_length = min(rle_length, _MAX_RUN + 1)  # + 1 for the literal
+        lb_copy_length_a = min(lb_copy_length_a, _MAX_RUN)
+        lb_copy_length_b = min(lb_copy_length_b, _MAX_RUN)
+        lb_copy_length_c = min(lb_copy_length_c, _MAX_RUN)
+
         # and now, Fight to the Death:tm:
         # whichever of these compressed more data wins
 
@@ -121,21 +171,23 @@ def compress_line(line: list, prev_line: list | None, first_line: bool):
             # rle not applicable
             # and does not appear anywhere on previous line
             # just write the colour to the buffer
-            active_colour = 0xE6 if pixel not in PALETTE else PALETTE.index(pixel)
+            active_colour = pixel
             buffer.append(active_colour)
         # HACK force RLE
         elif best_compression == "rle":
-            active_colour = 0xE6 if pixel not in PALETTE else PALETTE.index(pixel)
+            active_colour = pixel
             buffer.append(active_colour)
 
-            if rle_length >= 6:
+            # the literal is the first pixel of the run, the code repeats it
+            repeats = rle_length - 1
+            if repeats >= 6:
                 # RLE beyond 6 uses 6's code and a length
                 buffer.append(CONTROL_CODES["RLE_6"])
-                buffer.append(rle_length - 6)
+                buffer.append(repeats - 6)
             else:
-                buffer.append(CONTROL_CODES[f"RLE_{rle_length}"])
+                buffer.append(CONTROL_CODES[f"RLE_{repeats}"])
 
-            index += rle_length
+            index += rle_length - 1
 
         elif best_compression == "lb_-1":
             if 1 <= lb_copy_length_a <= 5:
@@ -164,3 +216,277 @@ def compress_line(line: list, prev_line: list | None, first_line: bool):
         index += 1
 
     return bytes(buffer)
+
+
+# Control codes by length (index 1-6, 6 meaning "6 or more").
+# Index 0 is never used.
+_RLE_CODES = np.array(
+    [0] + [CONTROL_CODES[f"RLE_{length}"] for length in range(1, 7)],
+    dtype=np.uint8,
+)
+# Rows are offset -1, 0, +1.
+_COPY_CODES = np.array(
+    [
+        [0]
+        + [CONTROL_CODES[f"COPY_{length}_OFFSET_{offset}"] for length in range(1, 7)]
+        for offset in (-1, 0, 1)
+    ],
+    dtype=np.uint8,
+)
+
+
+def _run_lengths(matches: np.ndarray) -> np.ndarray:
+    """
+    For each position in each row, count how many consecutive values
+    from there onwards are True.
+    """
+    width = matches.shape[1]
+    columns = np.arange(width)
+    # position of the next False at or after each position
+    stops = np.where(matches, width, columns)
+    next_stop = np.minimum.accumulate(stops[:, ::-1], axis=1)[:, ::-1]
+    return next_stop - columns
+
+
+def compress_mode9_numpy(image: PIL.Image.Image, data: bytes | None = None):
+    """
+    Compress an image with mode 9, computing the RLE and lookback runs for
+    every pixel at once with array operations.
+
+    This makes exactly the same choices as `compress_line`, so the output
+    is byte-identical; only the walk from one code
+    to the next is left in Python, and it takes one step per code written
+    rather than rescanning the row at every pixel.
+
+    :param data: The image's palette indices, if it's already quantised.
+    """
+    width, height = image.size
+    if data is None:
+        data = quantise(image)
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+    prev = np.roll(pixels, 1, axis=0)
+
+    # lookback matches; compress_line stops one pixel early for offset +1
+    matches_a = np.zeros((height, width), dtype=bool)
+    matches_a[:, 1:] = pixels[:, 1:] == prev[:, :-1]
+    matches_b = pixels == prev
+    matches_c = np.zeros((height, width), dtype=bool)
+    matches_c[:, :-1] = pixels[:, :-1] == prev[:, 1:]
+    # no lookback on the first line
+    matches_a[0] = matches_b[0] = matches_c[0] = False
+
+    matches_rle = np.zeros((height, width), dtype=bool)
+    matches_rle[:, :-1] = pixels[:, :-1] == pixels[:, 1:]
+    rle = _run_lengths(matches_rle)
+    rle = np.where(rle > 0, rle + 1, 0)
+
+    lengths = np.stack(
+        [rle, _run_lengths(matches_a), _run_lengths(matches_b), _run_lengths(matches_c)]
+    )
+    # as in compress_line, cap runs at what one code can cover
+    lengths[0] = np.minimum(lengths[0], _MAX_RUN + 1)
+    lengths[1:] = np.minimum(lengths[1:], _MAX_RUN)
+    # argmax picks the first of equal lengths, like max() over compare_dict
+    best = np.argmax(lengths, axis=0)
+    length = np.max(lengths, axis=0)
+    is_literal = length == 0
+    is_rle = ~is_literal & (best == 0)
+    is_copy = ~is_literal & (best != 0)
+    # pixels covered by the code itself; an RLE code follows a literal
+    run = np.where(is_rle, length - 1, length)
+
+    # the bytes each position would write if the walk lands on it
+    code_length = np.minimum(run, 6)
+    extension = np.maximum(run - 6, 0).astype(np.uint8)
+    copy_codes = _COPY_CODES[np.maximum(best - 1, 0), code_length]
+
+    tokens = np.zeros((height, width, 3), dtype=np.uint8)
+    tokens[..., 0] = np.where(is_copy, copy_codes, pixels)
+    tokens[..., 1] = np.where(is_rle, _RLE_CODES[code_length], extension)
+    tokens[..., 2] = extension
+    token_size = np.where(is_literal, 1, 1 + (run >= 6)) + is_rle
+    steps = np.maximum(length, 1)
+
+    # walk each row, one code at a time
+    visited = np.zeros((height, width), dtype=bool)
+    for y, row_steps in enumerate(steps.tolist()):
+        index = 0
+        while index < width:
+            visited[y, index] = True
+            index += row_steps[index]
+
+    selected = tokens[visited]
+    used = np.arange(3) < token_size[visited][:, None]
+    return selected[used].tobytes()
+
+
+def compress_mode9_optimal(image: PIL.Image.Image, data: bytes | None = None):
+    """
+    Compress an image with mode 9, using the fewest bytes possible.
+
+    Each row is encoded as a shortest path: from every pixel, the options
+    are a literal, a literal followed by an RLE code, or a copy from the
+    row above at offset -1, 0 or +1, each at any length the data allows.
+    Working back from the end of the row gives the cheapest way to finish
+    the row from every position.
+
+    :param data: The image's palette indices, if it's already quantised.
+    """
+    width, height = image.size
+    if data is None:
+        data = quantise(image)
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+
+    same_as_next = np.zeros((height, width), dtype=bool)
+    same_as_next[:, :-1] = pixels[:, :-1] == pixels[:, 1:]
+    # pixels after each one that an RLE code could repeat it into
+    repeats = _run_lengths(same_as_next)
+
+    copies = []
+    for offset in (-1, 0, 1):
+        matches = np.zeros((height, width), dtype=bool)
+        if offset == -1:
+            matches[1:, 1:] = pixels[1:, 1:] == pixels[:-1, :-1]
+        elif offset == 0:
+            matches[1:] = pixels[1:] == pixels[:-1]
+        else:
+            matches[1:, :-1] = pixels[1:, :-1] == pixels[:-1, 1:]
+        copies.append(_run_lengths(matches).tolist())
+
+    buffer = bytearray()
+    for y, row in enumerate(pixels.tolist()):
+        buffer.extend(
+            _encode_row_optimal(
+                row, repeats[y].tolist(), [copy_lengths[y] for copy_lengths in copies]
+            )
+        )
+    return bytes(buffer)
+
+
+def _cheapest(cost: list, start: int, stop: int) -> tuple[int, int]:
+    "Smallest cost[start:stop] and where it is, or (inf, -1) if empty."
+    if start >= stop:
+        return float("inf"), -1
+    best = min(cost[start:stop])
+    return best, cost.index(best, start, stop)
+
+
+def _length_codes(length: int, codes: dict) -> bytes:
+    "Encode a run length as its code, plus the extension byte for 6+."
+    if length >= 6:
+        return bytes([codes[6], length - 6])
+    return bytes([codes[length]])
+
+
+_RLE_BY_LENGTH = {length: CONTROL_CODES[f"RLE_{length}"] for length in range(1, 7)}
+_COPY_BY_LENGTH = [
+    {length: CONTROL_CODES[f"COPY_{length}_OFFSET_{offset}"] for length in range(1, 7)}
+    for offset in (-1, 0, 1)
+]
+
+
+def _encode_row_optimal(row: list, repeats: list, copies: list[list]) -> bytes:
+    "Shortest encoding of one row, see `compress_mode9_optimal`."
+    width = len(row)
+    # cost[i]: fewest bytes to encode row[i:]; choice[i]: how
+    cost = [0] * (width + 1)
+    choice = [None] * width
+
+    for index in range(width - 1, -1, -1):
+        # literal on its own
+        best_cost = 1 + cost[index + 1]
+        best_choice = ("literal", 0)
+
+        # literal, then RLE for 1-5 repeats (2 bytes) or 6+ (3 bytes)
+        max_repeats = min(repeats[index], _MAX_RUN)
+        after_literal = index + 1
+        for code_size, low, high in ((2, 1, 5), (3, 6, _MAX_RUN)):
+            value, end = _cheapest(
+                cost, after_literal + low, after_literal + min(max_repeats, high) + 1
+            )
+            if value + code_size < best_cost:
+                best_cost = value + code_size
+                best_choice = ("rle", end - after_literal)
+
+        # copy from the previous row: 1-5 pixels (1 byte) or 6+ (2 bytes)
+        for offset_index, copy_lengths in enumerate(copies):
+            max_length = min(copy_lengths[index], _MAX_RUN)
+            for code_size, low, high in ((1, 1, 5), (2, 6, _MAX_RUN)):
+                value, end = _cheapest(
+                    cost, index + low, index + min(max_length, high) + 1
+                )
+                if value + code_size < best_cost:
+                    best_cost = value + code_size
+                    best_choice = (offset_index, end - index)
+
+        cost[index] = best_cost
+        choice[index] = best_choice
+
+    buffer = bytearray()
+    index = 0
+    while index < width:
+        kind, length = choice[index]
+        if kind == "literal":
+            buffer.append(row[index])
+            index += 1
+        elif kind == "rle":
+            buffer.append(row[index])
+            buffer.extend(_length_codes(length, _RLE_BY_LENGTH))
+            index += 1 + length
+        else:
+            buffer.extend(_length_codes(length, _COPY_BY_LENGTH[kind]))
+            index += length
+    return bytes(buffer)
+
+
+def decompress_mode9(data: bytes, width: int, height: int) -> bytes:
+    """
+    Decode mode 9 data back to palette indices, one byte per pixel,
+    for checking the encoders' output.
+
+    RLE codes repeat the last literal colour; copy codes copy from the
+    row above, starting at the current position plus the code's offset.
+    """
+    rle_codes = {
+        code: int(name.split("_")[1])
+        for name, code in CONTROL_CODES.items()
+        if name.startswith("RLE_")
+    }
+    copy_codes = {
+        code: (int(name.split("_")[1]), int(name.split("_")[3]))
+        for name, code in CONTROL_CODES.items()
+        if name.startswith("COPY_")
+    }
+
+    buffer = bytearray()
+    prev_row = bytes(width)
+    index = 0
+    for _ in range(height):
+        row = bytearray()
+        active_colour = 0x00
+        while len(row) < width:
+            code = data[index]
+            index += 1
+            if code in rle_codes:
+                length = rle_codes[code]
+                if length == 6:
+                    length += data[index]
+                    index += 1
+                row.extend([active_colour] * length)
+            elif code in copy_codes:
+                length, offset = copy_codes[code]
+                if length == 6:
+                    length += data[index]
+                    index += 1
+                start = len(row) + offset
+                if start < 0 or start + length > width:
+                    raise ValueError("Copy from outside the row above")
+                row.extend(prev_row[start : start + length])
+            else:
+                active_colour = code
+                row.append(code)
+        if len(row) != width:
+            raise ValueError("Codes run past the end of a row")
+        prev_row = bytes(row)
+        buffer.extend(prev_row)
+    return bytes(buffer)
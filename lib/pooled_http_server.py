@@ -0,0 +1,121 @@
+"An HTTP server that handles requests on a fixed pool of worker threads."
+import http.server
+import queue
+import socket
+import threading
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """
+    `HTTPServer`, but requests are handed to a fixed number of worker threads
+    through a bounded queue instead of being served one at a time.
+
+    When every worker is busy and the queue is full, the connection is
+    answered straight away with `busy_response` and closed, so clients get
+    a quick "try again" rather than piling up behind a slow upstream site.
+    The response is sent without waiting for the request, so a slow client
+    being turned away doesn't hold up accepting the next connection.
+
+    :param workers: Number of requests served at the same time.
+    :param queue_depth: Number of accepted requests allowed to wait for a
+        worker. 0 turns requests away whenever no worker is free.
+    :param busy_response: Raw bytes sent to clients turned away when full.
+    """
+
+    # Turned-away connections waiting to be closed; past this many, they're
+    # closed straight away, and their clients may see a reset.
+    MAX_PENDING_REJECTIONS = 64
+
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        *,
+        workers: int = 8,
+        queue_depth: int = 16,
+        busy_response: bytes = b"HTTP/1.0 503 Service Unavailable\r\n\r\n",
+    ) -> None:
+        if workers < 1 or queue_depth < 0:
+            raise ValueError("Need at least one worker, and a queue depth of 0+")
+        # listen() backlog; must be set before the socket is activated
+        self.request_queue_size = max(queue_depth, 5)
+        super().__init__(server_address, handler_class)
+
+        self.busy_response = busy_response
+        # requests being served or waiting; a Queue can't be bounded at 0
+        self.__slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.__pending = queue.Queue()
+        self.__rejections = queue.Queue(maxsize=self.MAX_PENDING_REJECTIONS)
+        self.__threads = [
+            threading.Thread(
+                target=self.__worker, name=f"xiino-worker-{index}", daemon=True
+            )
+            for index in range(workers)
+        ]
+        self.__threads.append(
+            threading.Thread(target=self.__closer, name="xiino-closer", daemon=True)
+        )
+        for thread in self.__threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        "Queue the request for a worker, or turn it away if the queue is full."
+        if self.__slots.acquire(blocking=False):
+            self.__pending.put((request, client_address))
+            return
+        self.reject_request(request)
+
+    def reject_request(self, request) -> None:
+        """
+        Send the busy response and hang up. Doesn't block: the response is
+        small enough to go straight into the socket's send buffer.
+        """
+        try:
+            request.setblocking(False)
+            request.sendall(self.busy_response)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.shutdown_request(request)
+            return
+        # closing with the request still unread would reset the connection,
+        # which can lose the response, so that's left to __closer
+        try:
+            self.__rejections.put_nowait(request)
+        except queue.Full:
+            self.shutdown_request(request)
+
+    def __worker(self):
+        while True:
+            item = self.__pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=broad-exception-caught
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.__slots.release()
+
+    def __closer(self):
+        "Read and ignore what turned-away clients sent, then close."
+        while True:
+            request = self.__rejections.get()
+            if request is None:
+                break
+            try:
+                request.settimeout(0.5)
+                request.recv(65536)
+            except OSError:
+                pass
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in range(len(self.__threads) - 1):
+            self.__pending.put(None)
+        self.__rejections.put(None)
+        for thread in self.__threads:
+            thread.join()
@@ -2,7 +2,7 @@
 Experimental Scanline image compressor.
 Based on the implementation by Palm, Inc.
 """
-# pylint: disable=pointless-statement
+import numpy as np
 
 
 def compress_scanline(
@@ -17,6 +17,9 @@ def compress_scanline(
     (This should be true for sane images).
     If not, the function will throw an AssertionError.
 
+    This is the straightforward, one-byte-at-a-time version.
+    `compress_data_with_scanline` does whole images much faster.
+
     :param line: The data for the current line.
     :param prev_line: The data for the previous line.
     :param first_line: True if this is the first line of the image, otherwise false
@@ -53,9 +56,9 @@ def compress_scanline(
             changed_bytes_buffer = bytearray()
 
             for _ in range(0, 8):
-                flags << 1
+                flags <<= 1
                 if line[line_index] != prev_line[line_index]:
-                    flags += 1
+                    flags |= 1
                     changed_bytes_buffer.append(line[line_index])
                 line_index += 1
 
@@ -70,9 +73,9 @@ def compress_scanline(
             flags = 0x00
             changed_bytes_buffer = bytearray()
             for _ in range(0, width):
-                flags << 1
+                flags <<= 1
                 if line[line_index] != prev_line[line_index]:
-                    flags += 1
+                    flags |= 1
                     changed_bytes_buffer.append(line[line_index])
                 line_index += 1
             # pad flags byte
@@ -90,26 +93,71 @@ def compress_data_with_scanline(data: bytes, width: int) -> bytes:
     Helpful wrapper to compress a block of data with Scanline,
     instead of one line at a time.
 
+    Works out which bytes changed from the previous row for the whole
+    image at once, packs those into the flag bytes, and keeps just the
+    flags and changed bytes. The output is the same as calling
+    `compress_scanline` on every line.
+
     :param data: Image data.
     :param width: Width of one row of the image, in bytes.
     """
-    buffer = bytearray()
-
-    # assert (
-    #     len(data) % width == 0
-    # ), f"Invalid width {width} for data of length {len(data)}"
-    lines = list(__divide_chunks(data, width))
-
-    for index, line in enumerate(lines):
-        if index == 0:
-            buffer.extend(compress_scanline(line, None, True))
+    height, remainder = divmod(len(data), width)
+    groups = -(-width // 8)
+
+    rows = np.zeros((height, groups * 8), dtype=np.uint8)
+    rows[:, :width] = np.frombuffer(data, dtype=np.uint8, count=height * width).reshape(
+        height, width
+    )
+
+    # every byte "changes" on the first row; padding bytes never do
+    changed = np.zeros((height, groups * 8), dtype=bool)
+    changed[:1, :width] = True
+    changed[1:, :width] = rows[1:, :width] != rows[:-1, :width]
+
+    # one flag byte followed by up to 8 data bytes per group,
+    # then throw away the data bytes that didn't change
+    changed = changed.reshape(height, groups, 8)
+    output = np.empty((height, groups, 9), dtype=np.uint8)
+    output[..., 0] = np.packbits(changed, axis=2)[..., 0]
+    output[..., 1:] = rows.reshape(height, groups, 8)
+    keep = np.ones((height, groups, 9), dtype=bool)
+    keep[..., 1:] = changed
+
+    buffer = output[keep].tobytes()
+    if remainder:
+        # short last line, for data that isn't a whole number of rows
+        last_line = data[height * width :]
+        if height:
+            prev_line = data[(height - 1) * width : height * width]
+            buffer += compress_scanline(last_line, prev_line, False)
         else:
-            buffer.extend(compress_scanline(line, lines[index - 1], False))
-
+            buffer += compress_scanline(last_line, None, True)
     return buffer
 
 
-def __divide_chunks(l, n: int):
-    "Helper function for splitting things into chunks"
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
+def decompress_data_with_scanline(data: bytes, width: int, size: int) -> bytes:
+    """
+    Undo `compress_data_with_scanline`, for checking the compressor's output.
+
+    :param data: Scanline compressed data.
+    :param width: Width of one row of the image, in bytes.
+    :param size: Length of the uncompressed data, in bytes. If it isn't a
+        whole number of rows, the last row is short.
+    """
+    buffer = bytearray()
+    row = bytearray(width)
+    index = 0
+    while len(buffer) < size:
+        # each row starts as a copy of the one above
+        row = bytearray(row[: min(width, size - len(buffer))])
+        for group_start in range(0, len(row), 8):
+            flags = data[index]
+            index += 1
+            for bit in range(min(8, len(row) - group_start)):
+                if flags & (0x80 >> bit):
+                    row[group_start + bit] = data[index]
+                    index += 1
+        buffer.extend(row)
+    if index != len(data):
+        raise ValueError(f"{len(data) - index} bytes left over after decoding")
+    return bytes(buffer)
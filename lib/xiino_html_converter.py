@@ -1,79 +1,152 @@
+import base64
+import html
+import re
 import requests
 import random
-from lib.xiino_image_converter import EBDConverter
+import time
+from concurrent.futures import CancelledError, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import BinaryIO
+import lib.http_client as http_client
+from lib.device_profile import DeviceProfile
+from lib.encoding_pool import EncodingPool
+from lib.image_cache import ImageCache
+from lib.image_pipeline import ImageBudget, ImagePipeline, default_pipeline
+from lib.metrics import RequestTimings, stage
+from lib.xiino_image_converter import EBDConverter, EBDImage
 from html.parser import HTMLParser
-from urllib.parse import urljoin
+from urllib.parse import quote, unquote_to_bytes, urljoin
 from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 
-supported_tags = [
-    "A",
-    "ADDRESS",
-    "AREA",
-    "B",
-    "BASE",
-    "BASEFONT",
-    "BLINK",
-    "BLOCKQUOTE",
-    "BODY",
-    "BGCOLOR",
-    "BR",
-    "CLEAR",
-    "CENTER",
-    "CAPTION",
-    "CITE",
-    "CODE",
-    "DD",
-    "DIR",
-    "DIV",
-    "DL",
-    "DT",
-    "FONT",
-    "FORM",
-    "FRAME",
-    "FRAMESET",
-    "H1",
-    "H2",
-    "H3",
-    "H4",
-    "H5",
-    "H6",
-    "HR",
-    "I",
-    "IMG",
-    "INPUT",
-    "ISINDEX",
-    "KBD",
-    "LI",
-    "MAP",
-    "META",
-    "MULTICOL",
-    "NOBR",
-    "NOFRAMES",
-    "OL",
-    "OPTION",
-    "P",
-    "PLAINTEXT",
-    "PRE",
-    "S",
-    "SELECT",
-    "SMALL",
-    "STRIKE",
-    "STRONG",
-    "STYLE",
-    "SUB",
-    "SUP",
-    "TABLE",
-    "TITLE",  # why was this not included?
-    "TD",
-    "TH",
-    "TR",
-    "TT",
-    "U",
-    "UL",
-    "VAR",
-    "XMP",
-]
+# Tags Xiino understands, and the attributes it understands on each.
+# Everything else (class, style, data-*, event handlers...) is dropped.
+# Keys are lower case, as HTMLParser lower-cases tag and attribute names.
+_ALIGN = frozenset({"align"})
+_CELL = frozenset(
+    {"align", "valign", "colspan", "rowspan", "width", "height", "nowrap", "bgcolor"}
+)
+supported_tags: dict[str, frozenset[str]] = {
+    "a": frozenset({"href", "name", "target"}),
+    "address": frozenset(),
+    "area": frozenset({"shape", "coords", "href", "alt", "nohref", "target"}),
+    "b": frozenset(),
+    "base": frozenset({"href", "target"}),
+    "basefont": frozenset({"size", "color"}),
+    "blink": frozenset(),
+    "blockquote": frozenset(),
+    "body": frozenset({"bgcolor", "text", "link", "vlink", "alink"}),
+    "bgcolor": frozenset(),
+    "br": frozenset({"clear"}),
+    "clear": frozenset(),
+    "center": frozenset(),
+    "caption": _ALIGN,
+    "cite": frozenset(),
+    "code": frozenset(),
+    "dd": frozenset(),
+    "dir": frozenset({"compact"}),
+    "div": _ALIGN,
+    "dl": frozenset({"compact"}),
+    "dt": frozenset(),
+    "font": frozenset({"size", "color"}),
+    "form": frozenset({"action", "method", "enctype", "name", "target"}),
+    "frame": frozenset(
+        {"src", "name", "scrolling", "noresize", "marginwidth", "marginheight"}
+    ),
+    "frameset": frozenset({"rows", "cols", "border", "frameborder"}),
+    "h1": _ALIGN,
+    "h2": _ALIGN,
+    "h3": _ALIGN,
+    "h4": _ALIGN,
+    "h5": _ALIGN,
+    "h6": _ALIGN,
+    "hr": frozenset({"align", "size", "width", "noshade"}),
+    "i": frozenset(),
+    "img": frozenset({"src", "alt"}),  # rewritten by parse_image
+    "input": frozenset(
+        {"type", "name", "value", "size", "maxlength", "checked", "disabled"}
+    ),
+    "isindex": frozenset({"prompt", "action"}),
+    "kbd": frozenset(),
+    "li": frozenset({"type", "value"}),
+    "map": frozenset({"name"}),
+    "meta": frozenset({"http-equiv", "content"}),
+    "multicol": frozenset({"cols", "gutter", "width"}),
+    "nobr": frozenset(),
+    "noframes": frozenset(),
+    "ol": frozenset({"type", "start", "compact"}),
+    "option": frozenset({"value", "selected"}),
+    "p": _ALIGN,
+    "plaintext": frozenset(),
+    "pre": frozenset({"width"}),
+    "s": frozenset(),
+    "select": frozenset({"name", "size", "multiple"}),
+    "small": frozenset(),
+    "strike": frozenset(),
+    "strong": frozenset(),
+    "sub": frozenset(),
+    "sup": frozenset(),
+    "table": frozenset(
+        {"align", "border", "cellpadding", "cellspacing", "width", "bgcolor"}
+    ),
+    "title": frozenset(),  # why was this not included?
+    "td": _CELL,
+    "th": _CELL,
+    "tr": frozenset({"align", "valign", "bgcolor"}),
+    "tt": frozenset(),
+    "u": frozenset(),
+    "ul": frozenset({"type", "compact"}),
+    "var": frozenset(),
+    "xmp": frozenset(),
+}
+
+# Tags with no end tag; `<br/>` would otherwise also emit `</BR>`.
+VOID_TAGS = frozenset(
+    {"area", "base", "basefont", "br", "frame", "hr", "img", "input", "isindex", "meta"}
+)
+# Tags whose text is shown as is, so whitespace can't be collapsed.
+PREFORMATTED_TAGS = frozenset({"pre", "xmp", "plaintext"})
+# Tags whose whole contents are dropped, as Xiino can't show any of it.
+# NOSCRIPT isn't one: scripts never reach Xiino, so its fallback content
+# is exactly what the page wants shown.
+SKIPPED_TAGS = frozenset(
+    {"script", "style", "svg", "math", "template", "iframe", "object", "applet"}
+)
+
+# HTML's own whitespace only; \s would also collapse &nbsp; (U+00A0)
+_WHITESPACE_REGEX = re.compile(r"[ \t\n\r\f]+")
+
+
+# Internal URL that shows a single image on its own page.
+DEFERRED_IMAGE_URL = "http://image/"
+
+
+def deferred_image_url(image_url: str) -> str:
+    "Link to the page showing just this image."
+    return f"{DEFERRED_IMAGE_URL}?src={quote(image_url, safe='')}"
+
+
+def decode_data_url(url: str) -> bytes:
+    "The contents of a `data:` URL. Raises ValueError if it's malformed."
+    header, comma, data = url[len("data:") :].partition(",")
+    if not comma:
+        raise ValueError("data: URL has no comma")
+    if header.lower().endswith(";base64"):
+        # b64decode skips the whitespace some pages wrap the data in
+        return base64.b64decode(unquote_to_bytes(data))
+    return unquote_to_bytes(data)
+
+
+@dataclass
+class ImageSlot:
+    "An image being fetched and converted, and where it goes in the page."
+
+    future: Future
+    url: str
+    alt_text: str | None = None
+    # inside an <A>, where it can't be replaced by a link of its own
+    in_link: bool = False
 
 
 class XiinoHTMLParser(HTMLParser):
@@ -84,11 +157,76 @@ class XiinoHTMLParser(HTMLParser):
         *,
         base_url,
         convert_charrefs: bool = True,
+        image_pipeline: ImagePipeline | None = None,
+        encoding_pool: EncodingPool | None = None,
+        image_cache: ImageCache | None = None,
+        mode9_engine: str = "numpy",
+        image_mode: str = "compressed",
+        output: BinaryIO | None = None,
+        write_buffer_size: int = 2048,
+        device_profile: DeviceProfile | None = None,
+        image_budget: ImageBudget | None = None,
+        timings: RequestTimings | None = None,
+        deadline: float | None = None,
+        max_image_bytes: int | None = None,
+        max_image_pixels: int | None = None,
     ) -> None:
-        self.parsing_supported_tag = True
-        self.__parsed_data_buffer = ""
+        """
+        :param device_profile: What the device can display; images are
+            converted to suit it. Defaults to a colour device.
+        :param image_mode: "compressed" always sends the device's compressed
+            mode (e.g. mode 9). "auto" also tries the uncompressed mode and
+            sends whichever is smaller.
+        :param image_budget: Limits on images inlined into the page;
+            the rest become links. Defaults to no limits.
+        :param deadline: `time.monotonic()` time by which the whole page
+            should be done. Image fetches are cut short to fit, and images
+            that aren't ready by then become links.
+        :param max_image_bytes: Images bigger than this are skipped, without
+            downloading more of them than that.
+        :param max_image_pixels: Images with more pixels than this are
+            skipped, going by their header, before they are decoded.
+        :param timings: If given, time spent fetching, converting and
+            writing is added to it, along with counts of images.
+        :param output: If given, parsed data is streamed to this file
+            (e.g. the request's `wfile`) as soon as about `write_buffer_size`
+            characters are ready, instead of waiting for get_parsed_data.
+            Call close() after the last feed() to write the rest.
+        """
+        # Open elements in SKIPPED_TAGS; nothing inside them is emitted.
+        self.__skip_stack: list[str] = []
+        # Parsed output, in document order. Images are still being fetched
+        # and converted while we parse, so they sit in here as ImageSlots
+        # until they are spliced in.
+        self.__parsed_data_buffer: list[str | ImageSlot] = []
+        self.__buffered_size = 0
+        self.output = output
+        self.write_buffer_size = write_buffer_size
         self.ebd_image_tags = []
+        # whitespace is collapsed to one character, and dropped if the text
+        # before it already ended with some
+        self.__after_whitespace = True
+        self.__preformatted = 0
+        # <A> elements open right now
+        self.__open_links = 0
         self.base_url = base_url
+        self.image_pipeline = image_pipeline or default_pipeline()
+        self.encoding_pool = encoding_pool
+        self.image_cache = image_cache
+        self.mode9_engine = mode9_engine
+        self.image_mode = image_mode
+        self.device_profile = device_profile or DeviceProfile()
+        self.image_budget = image_budget or ImageBudget()
+        self.timings = timings
+        self.deadline = deadline
+        self.max_image_bytes = max_image_bytes
+        self.max_image_pixels = max_image_pixels
+        self.__images_queued = 0
+        # One job and one EBD slot per image URL, however often it's used.
+        self.__image_jobs: dict[str, Future] = {}
+        self.__ebd_refs: dict[str, int] = {}
+        self.__image_bytes = 0
+        self.__image_deadline: float | None = None
 
         self.requests_headers = {
             "User-Agent": "OpenXiino/1.0 (http://github.com/nicl83/openxiino) python-requests/2.27.1"
@@ -97,21 +235,30 @@ class XiinoHTMLParser(HTMLParser):
         super().__init__(convert_charrefs=convert_charrefs)
 
     def handle_starttag(self, tag, attrs):
-        if tag.upper() in supported_tags:
+        if tag in SKIPPED_TAGS:
+            self.__skip_stack.append(tag)
+            return
+        if self.__skip_stack:
+            return
+
+        allowed_attrs = supported_tags.get(tag)
+        if allowed_attrs is not None:
             if tag == "img":
                 # Put EBD logic here
-                source_url = [attr[1] for attr in attrs if attr[0].lower() == "src"]
-                if source_url:
+                source_url = [attr[1] for attr in attrs if attr[0] == "src"]
+                alt_text = [attr[1] for attr in attrs if attr[0] == "alt"]
+                if source_url and source_url[0]:
                     true_url = source_url[0]
-                    self.parse_image(true_url)
+                    self.parse_image(true_url, alt_text[0] if alt_text else None)
                 else:
                     print(f"WARNING: IMG with no SRC at {self.base_url}")
             else:
                 if tag == "a":
+                    self.__open_links += 1
                     # fix up links for poor little browser
                     new_attrs = []
                     for attr in attrs:
-                        if attr[0] == "href":
+                        if attr[0] == "href" and attr[1] is not None:
                             new_url = urljoin(self.base_url, attr[1])
                             if new_url.startswith("https:"):
                                 new_url = new_url.replace("https:", "http:", 1)
@@ -120,66 +267,392 @@ class XiinoHTMLParser(HTMLParser):
                             new_attrs.append(attr)
                     attrs = new_attrs
 
-                self.parsing_supported_tag = True
-                self.__parsed_data_buffer += f"<{tag.upper()} "
-                self.__parsed_data_buffer += " ".join(
-                    f'{x[0].upper()}="{x[1]}"' for x in attrs
-                )
-                self.__parsed_data_buffer += ">\n"
-
-        else:
-            self.parsing_supported_tag = False
+                if tag in PREFORMATTED_TAGS:
+                    self.__preformatted += 1
+                self.__emit(self.__start_tag(tag, attrs, allowed_attrs))
 
     def handle_data(self, data):
-        if self.parsing_supported_tag:
-            self.__parsed_data_buffer += data.strip()
-            if len(data) > 0:
-                self.__parsed_data_buffer += "\n"
+        # text in unsupported tags (SPAN, EM, ARTICLE...) is still shown,
+        # only the tags themselves are dropped
+        if self.__skip_stack:
+            return
+        if self.__preformatted:
+            self.__emit(data)
+            return
+        # a run of whitespace becomes a newline if it had one (to keep
+        # lines short), or a space
+        data = _WHITESPACE_REGEX.sub(
+            lambda match: "\n" if "\n" in match.group() else " ", data
+        )
+        if self.__after_whitespace:
+            data = data.lstrip(" \n")
+        if data:
+            self.__emit(data)
+            self.__after_whitespace = data[-1] in " \n"
 
     def handle_endtag(self, tag):
-        if tag.upper() in supported_tags:
-            self.__parsed_data_buffer += f"</{tag.upper()}>\n"
+        if self.__skip_stack:
+            if tag in self.__skip_stack:
+                # the innermost open one; closes anything left open inside it
+                depth = len(self.__skip_stack) - 1 - self.__skip_stack[::-1].index(tag)
+                del self.__skip_stack[depth:]
+            return
+        if tag in supported_tags and tag not in VOID_TAGS:
+            if tag in PREFORMATTED_TAGS and self.__preformatted:
+                self.__preformatted -= 1
+            if tag == "a" and self.__open_links:
+                self.__open_links -= 1
+            self.__emit(f"</{tag.upper()}>")
+
+    @staticmethod
+    def __start_tag(tag: str, attrs: list, allowed_attrs: frozenset[str]) -> str:
+        "Markup for a start tag, keeping only the attributes Xiino knows."
+        parts = [tag.upper()]
+        for name, value in attrs:
+            if name not in allowed_attrs:
+                continue
+            if value is None:
+                parts.append(name.upper())
+            else:
+                # HTMLParser has unescaped it, e.g. "&amp;copy=" to "&copy="
+                parts.append(f'{name.upper()}="{html.escape(value)}"')
+        return f"<{' '.join(parts)}>"
 
     def get_parsed_data(self):
-        "Get the parsed data from the buffer, then clear it."
+        """
+        Get the parsed data from the buffer, then clear it.
+        Blocks until every image on the page has been fetched and converted.
+        """
+        output = self.__take_ready(block=True)
         for tag in self.ebd_image_tags:
-            self.__parsed_data_buffer += tag + "\n"
-        data = self.__parsed_data_buffer
-        self.__parsed_data_buffer = ""
+            output.append(tag + "\n")
         self.ebd_image_tags = []
-        return data
+        return "".join(output)
+
+    def close(self):
+        """
+        Finish parsing. When streaming, this writes everything that's left,
+        waiting for any images that are still being converted.
+        """
+        super().close()
+        if self.output is not None:
+            self.__write(self.get_parsed_data())
 
-    def parse_image(self, url: str):
+    def __emit(self, data: str):
+        "Add parsed data to the output, streaming it out if enough is ready."
+        self.__parsed_data_buffer.append(data)
+        self.__buffered_size += len(data)
+        if self.output is not None and self.__buffered_size >= self.write_buffer_size:
+            self.__write("".join(self.__take_ready(block=False)))
+
+    def __take_ready(self, block: bool) -> list[str]:
+        """
+        Remove parts from the front of the buffer and return them as text,
+        splicing in finished images. Without `block`, stops at the first
+        image that isn't ready yet.
+        """
+        ready = []
+        taken = 0
+        for part in self.__parsed_data_buffer:
+            if isinstance(part, ImageSlot):
+                if not block and not part.future.done() and not self.__out_of_time():
+                    break
+                part = self.__splice_image(part)
+            ready.append(part)
+            taken += 1
+        if taken:
+            del self.__parsed_data_buffer[:taken]
+            self.__buffered_size = sum(
+                len(part) for part in self.__parsed_data_buffer if isinstance(part, str)
+            )
+        return ready
+
+    def __write(self, data: str):
+        if data:
+            encoded = data.encode("latin-1", errors="ignore")
+            with stage(self.timings, "write"):
+                self.output.write(encoded)
+            self.__count("bytes_written", len(encoded))
+
+    def parse_image(self, url: str, alt_text: str | None = None):
+        """
+        Queue an image to be fetched and converted, and reserve its place
+        in the output. The EBD slot number is only assigned once the image
+        is spliced back in, so failed images don't leave gaps.
+        Once the page's image budget is spent, a link is added instead.
+        An image that's already on the page reuses the first one's job.
+        """
         full_url = urljoin(self.base_url, url)
-        image_buffer = BytesIO(
-            requests.get(full_url, timeout=5, headers=self.requests_headers).content
+        job = self.__image_jobs.get(full_url)
+        if job is not None:
+            self.__count("images_repeated")
+            self.__parsed_data_buffer.append(
+                ImageSlot(job, full_url, alt_text, self.__open_links > 0)
+            )
+            return
+
+        budget = self.image_budget
+        if (
+            (
+                budget.max_images is not None
+                and self.__images_queued >= budget.max_images
+            )
+            or (budget.max_bytes is not None and self.__image_bytes >= budget.max_bytes)
+            or self.__out_of_time()
+        ):
+            self.__emit(
+                self.__deferred_image_link(full_url, alt_text, self.__open_links > 0)
+            )
+            return
+
+        if self.__image_deadline is None and budget.max_seconds is not None:
+            self.__image_deadline = time.monotonic() + budget.max_seconds
+        self.__images_queued += 1
+        job = self.image_pipeline.submit(self.load_image, full_url)
+        self.__image_jobs[full_url] = job
+        self.__parsed_data_buffer.append(
+            ImageSlot(job, full_url, alt_text, self.__open_links > 0)
         )
 
+    def load_image(self, full_url: str) -> EBDImage | None:
+        """
+        Fetch and convert a single image. Runs on the image pipeline.
+        Returns None if the image can't be shown on Xiino.
+        `data:` images are decoded here rather than fetched, and not cached.
+        """
+        if full_url.startswith("data:"):
+            try:
+                content = decode_data_url(full_url)
+            except ValueError:
+                print("Warn: unsupported image due to a malformed data: URL at")
+                print(self.base_url)
+                self.__count("images_unsupported")
+                return None
+            self.__count("images_inline")
+            return self.convert_image(content, f"a data: URL at {self.base_url}")
+
+        cache_key = ImageCache.key(
+            full_url, self.device_profile.ebd_mode, self.device_profile.image_width
+        )
+        cached = None
+        request_headers = self.requests_headers
+        if self.image_cache is not None:
+            cached, fresh = self.image_cache.lookup(cache_key)
+            if fresh:
+                self.__count("images_cached")
+                return cached.image
+            if cached is not None:
+                request_headers = request_headers | cached.conditional_headers()
+
+        with stage(self.timings, "image_fetch"):
+            with self.image_pipeline.host_slot(full_url):
+                response = http_client.get(
+                    full_url,
+                    timeout=5,
+                    deadline=self.deadline,
+                    headers=request_headers,
+                    stream=True,
+                )
+                try:
+                    content = http_client.read_limited(response, self.max_image_bytes)
+                except http_client.ResponseTooLarge as error:
+                    print(f"Warn: image skipped for being too big: {error}")
+                    self.__count("images_too_large")
+                    return None
+
+        if cached is not None and response.status_code == 304:
+            self.image_cache.mark_not_modified(cache_key)
+            self.__count("images_cached")
+            return cached.image
+
+        ebd_image = self.convert_image(content, full_url)
+        if ebd_image is not None and self.image_cache is not None:
+            self.image_cache.store(
+                cache_key,
+                ebd_image,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        return ebd_image
+
+    def convert_image(self, content: bytes, source: str) -> EBDImage | None:
+        """
+        Decode and convert an image for the device.
+        Returns None if it can't be shown on Xiino.
+
+        :param source: Where the image came from, for warnings.
+        """
+        image_buffer = BytesIO(content)
+
         try:
             image = Image.open(image_buffer)
         except UnidentifiedImageError as exception_info:
-            print("Warn: unsupported image due to unsupported format at", full_url)
+            print("Warn: unsupported image due to unsupported format at", source)
             print(exception_info.args[0])
-            self.__parsed_data_buffer += "<p>[Unsupported image]</p>"
             image_buffer.close()
-            return
+            self.__count("images_unsupported")
+            return None
+        except Image.DecompressionBombError as exception_info:
+            print("Warn: image skipped at", source)
+            print(exception_info.args[0])
+            image_buffer.close()
+            self.__count("images_too_large")
+            return None
 
         # pre-filter images
         if image.width / 2 <= 1 or image.width / 2 <= 1:
-            print("Warn: unsupported image due to being too small at", full_url)
-            self.__parsed_data_buffer += "<p>[Unsupported image]</p>"
-            return
+            print("Warn: unsupported image due to being too small at", source)
+            image_buffer.close()
+            self.__count("images_unsupported")
+            return None
+
+        # Image.open only reads the header, so this is before any decoding
+        if (
+            self.max_image_pixels is not None
+            and image.width * image.height > self.max_image_pixels
+        ):
+            print(
+                f"Warn: image skipped for being {image.width}x{image.height} at",
+                source,
+            )
+            image_buffer.close()
+            self.__count("images_too_large")
+            return None
+
+        if self.__out_of_time():
+            # the page has given up on this image, don't convert it
+            raise http_client.DeadlineExceeded(f"No time left to convert {source}")
+
+        # PIL only reads the pixels when they're first needed, in here
+        with stage(self.timings, "image_decode"):
+            try:
+                ebd_converter = EBDConverter(
+                    image,
+                    max_width=self.device_profile.image_width,
+                    timings=self.timings,
+                )
+            except (OSError, SyntaxError, ValueError) as exception_info:
+                # a readable header, but broken or cut off image data
+                print("Warn: unsupported image due to bad image data at", source)
+                print(exception_info)
+                self.__count("images_unsupported")
+                return None
+            finally:
+                image_buffer.close()
 
-        ebd_converter = EBDConverter(image)
+        conversions = self.device_profile.conversions()
+        if self.image_mode != "auto":
+            conversions = conversions[:1]
+        for method, kwargs in conversions:
+            if method == "convert_colour":
+                kwargs["engine"] = self.mode9_engine
+        if len(conversions) == 1:
+            method, kwargs = conversions[0]
+        else:
+            method, kwargs = "convert_smallest", {"conversions": conversions}
+        with stage(self.timings, "image_encode"):
+            if self.encoding_pool is not None:
+                ebd_image = self.encoding_pool.encode(
+                    ebd_converter.image, method, **kwargs
+                )
+            else:
+                ebd_image = getattr(ebd_converter, method)(**kwargs)
+        self.__count("images_converted")
+        self.__count(f"images_mode{ebd_image.mode}")
+        return ebd_image
 
-        colour_data = ebd_converter.convert_colour(compressed=True)
+    def __splice_image(self, slot: ImageSlot) -> str:
+        """
+        Turn an image job into markup, taking the next EBD slot, or sharing
+        the slot of an earlier use of the same image.
+        Waits for the job, up to the end of the page's image time budget
+        or the page's deadline. Images that run out of time, can't be
+        fetched or fail to convert become links, so they can still be
+        loaded (or at least tried) on their own.
+        """
+        timeout = None
+        deadline = self.__deadline()
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            with stage(self.timings, "image_wait"):
+                ebd_image = slot.future.result(timeout=timeout)
+        except (FutureTimeoutError, CancelledError):
+            # cancel() only stops jobs that haven't started; the rest carry
+            # on until their next deadline check, and are then thrown away
+            slot.future.cancel()
+            self.__count("images_timed_out")
+            return self.__deferred_image_link(slot.url, slot.alt_text, slot.in_link)
+        except requests.RequestException as error:
+            print(f"Warn: couldn't fetch image at {slot.url}: {error}")
+            self.__count("images_failed")
+            return self.__deferred_image_link(slot.url, slot.alt_text, slot.in_link)
+        except Exception as error:  # pylint: disable=broad-except
+            # e.g. a truncated file; the rest of the page is still worth sending
+            print(f"Warn: couldn't convert image at {slot.url}: {error!r}")
+            self.__count("images_failed")
+            return self.__deferred_image_link(slot.url, slot.alt_text, slot.in_link)
+
+        if ebd_image is None:
+            return "<p>[Unsupported image]</p>"
+
+        ebd_ref = self.__ebd_refs.get(slot.url)
+        if ebd_ref is not None:
+            return (
+                ebd_image.generate_img_tag(name=f"#{ebd_ref}", alt_text=slot.alt_text)
+                + "\n"
+            )
+
+        max_bytes = self.image_budget.max_bytes
+        if (
+            max_bytes is not None
+            and self.__image_bytes + len(ebd_image.raw_data) > max_bytes
+        ):
+            self.__image_bytes = max_bytes  # don't inline anything else either
+            return self.__deferred_image_link(slot.url, slot.alt_text, slot.in_link)
+        self.__image_bytes += len(ebd_image.raw_data)
 
         ebd_ref = len(self.ebd_image_tags) + 1  # get next "slot"
-        self.__parsed_data_buffer += (
-            colour_data.generate_img_tag(name=f"#{ebd_ref}") + "\n"
+        self.__ebd_refs[slot.url] = ebd_ref
+        with stage(self.timings, "base64"):
+            self.ebd_image_tags.append(ebd_image.generate_ebdimage_tag(name=ebd_ref))
+        return (
+            ebd_image.generate_img_tag(name=f"#{ebd_ref}", alt_text=slot.alt_text)
+            + "\n"
         )
-        self.ebd_image_tags.append(colour_data.generate_ebdimage_tag(name=ebd_ref))
-        image_buffer.close()
+
+    def __deadline(self) -> float | None:
+        "When the page's image time budget or its deadline runs out, if ever."
+        deadlines = [
+            deadline
+            for deadline in (self.__image_deadline, self.deadline)
+            if deadline is not None
+        ]
+        return min(deadlines, default=None)
+
+    def __out_of_time(self) -> bool:
+        "Has the page's image time budget or its deadline run out?"
+        deadline = self.__deadline()
+        return deadline is not None and time.monotonic() >= deadline
+
+    def __deferred_image_link(
+        self, url: str, alt_text: str | None, in_link: bool
+    ) -> str:
+        """
+        A link to load an image that didn't fit in the page's budget.
+        Inside another link, it's just a label, as links can't nest.
+        """
+        self.__count("images_deferred")
+        label = f"[Image: {html.escape(alt_text)}]" if alt_text else "[Image]"
+        if in_link or url.startswith("data:"):
+            # a data: link would carry the whole image, so just say it's there
+            return f"{label}\n"
+        return f'<A HREF="{deferred_image_url(url)}">{label}</A>\n'
+
+    def __count(self, name: str, amount: int = 1):
+        "Add to one of the request's counts, if it's being timed."
+        if self.timings is not None:
+            self.timings.count(name, amount)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
 "Classes for converting from PIL image to Xiino-format bytes."
+import html
 import math
 from base64 import b64encode
 from dataclasses import dataclass
 import PIL.Image
-import PIL.ImageOps
-import bitstring
+import numpy as np
 import lib.scanline as scanline
 import lib.mode9 as mode9
-from lib.xiino_palette_common import PALETTE
+from lib.metrics import RequestTimings, stage
+from lib.xiino_palette_common import quantise
+
+# Greyscale lookup tables: invert (Xiino's 0 is white) and cut down to
+# the sample size.
+_MODE2_LUT = [(255 - value) // 64 for value in range(256)]
+# round() can reach 16 for the darkest greys, which doesn't fit in 4 bits
+_MODE4_LUT = [min(round((255 - value) / 16), 15) for value in range(256)]
 
 
 @dataclass
@@ -30,7 +37,8 @@ class EBDImage:
 
     def generate_img_tag(self, name, alt_text: str | None = None) -> str:
         "Generate an IMG tag for this image."
-        return f"""<IMG ALT="{alt_text}" WIDTH="{self.width}" HEIGHT="{self.height}" EBDWIDTH="{self.width}" EBDHEIGHT="{self.height}" EBD="{name}">"""
+        alt = f'ALT="{html.escape(alt_text)}" ' if alt_text is not None else ""
+        return f"""<IMG {alt}WIDTH="{self.width}" HEIGHT="{self.height}" EBDWIDTH="{self.width}" EBDHEIGHT="{self.height}" EBD="{name}">"""
 
 
 class EBDConverter:
@@ -38,27 +46,47 @@ class EBDConverter:
     Convert from a PIL image to any of the modes known to be supported by Xiino.
     """
 
+    # Widest image on a standard (160px) Palm screen.
+    STANDARD_WIDTH = 153
+
     def __init__(
-        self, image: PIL.Image.Image | str, override_scale_logic: bool = False
+        self,
+        image: PIL.Image.Image | str,
+        override_scale_logic: bool = False,
+        max_width: int = STANDARD_WIDTH,
+        timings: RequestTimings | None = None,
     ) -> None:
         # Image is resized at class init to meet Xiino's specification.
         # To quote "HTMLSpecifications.txt":
         # Size WIDTH > 306pixel -> WIDTH = 153pixel（reduced to 153 pixels）
         # WIDTH <= 306pixel -> WIDTH = WIDTH * 0.5pixel（reduce to half the width）
         # HEIGHT is reduced to the same proportion as WIDTH.
+        # For high-density devices, `max_width` takes the place of 153,
+        # and everything is scaled up to match.
+        # `timings`, if given, gets the time spent in each encoding step.
 
+        self.timings = timings
+        # palette indices, worked out once for both modes 8 and 9
+        self.__quantised: bytes | None = None
         if isinstance(image, str):
             image = PIL.Image.open(image)
 
         if not override_scale_logic:
-            if image.width > 306:
-                new_width = 153
-                new_height = math.ceil((image.height / image.width) * 153)
+            if image.width > self.STANDARD_WIDTH * 2:
+                new_width = max_width
+                new_height = math.ceil((image.height / image.width) * max_width)
             else:
-                new_width = math.ceil(image.width / 2)
-                new_height = math.ceil(image.height / 2)
+                scale = max_width / (self.STANDARD_WIDTH * 2)
+                new_width = math.ceil(image.width * scale)
+                new_height = math.ceil(image.height * scale)
 
-            image = image.resize((new_width, new_height))
+            # Have JPEGs decoded at 1/2, 1/4 or 1/8 scale when that's still
+            # bigger than the target, rather than decoding every pixel of a
+            # huge photo just to throw most of them away. No-op for others.
+            image.draft("RGB", (new_width, new_height))
+            # reducing_gap shrinks by whole factors first (cheap), and only
+            # does the proper resample on the last step
+            image = image.resize((new_width, new_height), reducing_gap=3.0)
 
         # discard transparency... this'll help later, trust me
         # do this by compositing the image onto a white background
@@ -114,27 +142,35 @@ class EBDConverter:
         elif depth == 4:
             if compressed:
                 return EBDImage(
-                    self.__convert_mode4(),
+                    self.__convert_mode5(),
                     width=self.image.width,
                     height=self.image.height,
-                    mode=4,
+                    mode=5,
                 )
             return EBDImage(
-                self.__convert_mode5(),
+                self.__convert_mode4(),
                 width=self.image.width,
                 height=self.image.height,
-                mode=5,
+                mode=4,
             )
         else:
             raise ValueError("Unsupported bit depth for greyscale.")
 
-    def convert_colour(self, compressed: bool = False) -> EBDImage:
-        "Convert the image to 8-bit (231 colour)."
-        # TODO: uncompressed/mode8
-        # not hard but getting burned out
+    def convert_colour(
+        self, compressed: bool = False, engine: str = "numpy"
+    ) -> EBDImage:
+        """
+        Convert the image to 8-bit (231 colour).
+        `engine` picks the mode 9 encoder, see `mode9.compress_mode9`.
+        """
         if compressed:
             return EBDImage(
-                mode9.compress_mode9(self.image),
+                mode9.compress_mode9(
+                    self.image,
+                    engine=engine,
+                    timings=self.timings,
+                    data=self.__quantise(),
+                ),
                 width=self.image.width,
                 height=self.image.height,
                 mode=9,
@@ -146,111 +182,103 @@ class EBDConverter:
             mode=8,
         )
 
+    def convert_smallest(self, conversions: list[tuple[str, dict]]) -> EBDImage:
+        """
+        Try each conversion, e.g. from `DeviceProfile.conversions`, and
+        keep the smallest result. Compression doesn't always pay off: mode 9
+        can come out bigger than mode 8 for noisy photos, and Scanline
+        bigger than raw data for dithered greyscale.
+        On a tie, the earlier conversion wins.
+
+        :param conversions: `(method name, keyword arguments)` pairs.
+        """
+        smallest = None
+        for method, kwargs in conversions:
+            ebd_image = getattr(self, method)(**kwargs)
+            if smallest is None or len(ebd_image.raw_data) < len(smallest.raw_data):
+                smallest = ebd_image
+        return smallest
+
     def __convert_mode0(self) -> bytes:
         """
         Internal function for converting to mode0 (one-bit, no compression.)
         """
-        buf = []
-        im_bw = self.image.convert("1")
-        for y in range(0, self.image.height):
-            row_data = [im_bw.getpixel((x, y)) for x in range(0, self.image.width)]
-            for chunk in self.__divide_chunks(row_data, 8):
-                binary = bitstring.BitArray(bin="0b00000000")
-                index = 0
-                for pixel in chunk:
-                    if pixel:
-                        binary.set(False, index)
-                    else:
-                        binary.set(True, index)
-                    index += 1
-                buf.append(binary.uint)
-        return bytes(buf)
+        # mode "1" arrays come out as bool, True for white;
+        # Xiino wants a set bit for black
+        black = ~np.asarray(self.image.convert("1"))
+        return np.packbits(black, axis=1).tobytes()
 
     def __convert_mode1(self) -> bytes:
         """
         Internal function for converting to mode1 (one-bit, scanline compression)
         """
-        # TODO writing a scanline converter is hurting my brain. later.
-        return self.__convert_mode0()
+        width_bytes = math.ceil(self.image.width / 8)
+        return self.__scanline(self.__convert_mode0(), width_bytes)
 
     def __convert_mode2(self) -> bytes:
         """
         Internal function to convert to uncompressed two-bit grey.
         """
-        buf = []
-        im_gs = PIL.ImageOps.invert(self.image.convert("L"))
-        raw_data = list(im_gs.getdata())
-        for y in range(0, self.image.height):
-            raw_data = [im_gs.getpixel((x, y)) for x in range(0, self.image.width)]
-            for chunk in self.__divide_chunks(raw_data, 4):
-                if len(chunk) == 1:
-                    byte = math.floor(chunk[0] / 64) << 6
-                elif len(chunk) == 2:
-                    byte = (
-                        math.floor(chunk[0] / 64) << 6 | math.floor(chunk[1] / 64) << 4
-                    )
-                elif len(chunk) == 3:
-                    byte = (
-                        math.floor(chunk[0] / 64) << 6
-                        | math.floor(chunk[1] / 64) << 4
-                        | math.floor(chunk[2] / 64) << 2
-                    )
-                elif len(chunk) == 4:
-                    byte = (
-                        math.floor(chunk[0] / 64) << 6
-                        | math.floor(chunk[1] / 64) << 4
-                        | math.floor(chunk[2] / 64) << 2
-                        | math.floor(chunk[3] / 64)
-                    )
-                buf.append(byte)
-
-        return bytes(buf)
+        # invert and drop to 2 bits in one pass
+        im_gs = self.image.convert("L").point(_MODE2_LUT)
+        return self.__pack_samples(np.asarray(im_gs), 2)
 
     def __convert_mode3(self) -> bytes:
         """
         Internal function to convert to Scanline compressed two-bit grey.
         """
-        width_bytes = math.ceil(self.image.width / 2)
-        return scanline.compress_data_with_scanline(self.__convert_mode2(), width_bytes)
+        width_bytes = math.ceil(self.image.width / 4)  # four pixels per byte
+        return self.__scanline(self.__convert_mode2(), width_bytes)
 
     def __convert_mode4(self) -> bytes:
         """
         Internal function to convert to uncompressed four-bit grey.
         """
-        buf = []
-        im_gs = PIL.ImageOps.invert(self.image.convert("L"))
-        for y in range(0, self.image.height):
-            raw_data = [im_gs.getpixel((x, y)) for x in range(0, self.image.width)]
-            for chunk in self.__divide_chunks(raw_data, 2):
-                byte = (round(chunk[0] / 16)) << 4 | (
-                    0 if len(chunk) < 2 else round(chunk[1] / 16)
-                ) << 0
-                buf.append(byte)
-
-        return bytes(buf)
+        im_gs = self.image.convert("L").point(_MODE4_LUT)
+        return self.__pack_samples(np.asarray(im_gs), 4)
 
     def __convert_mode5(self) -> bytes:
         """
         Internal function to convert to Scanline compressed four-bit grey.
         """
-        width_bytes = math.ceil(self.image.width / 4)
-        return scanline.compress_data_with_scanline(self.__convert_mode4(), width_bytes)
+        width_bytes = math.ceil(self.image.width / 2)  # two pixels per byte
+        return self.__scanline(self.__convert_mode4(), width_bytes)
 
     def __convert_mode8(self) -> bytes:
-        xiino_palette = PIL.Image.open("lib/paletised.png")
-        image = self.image.quantize(palette=xiino_palette).convert("RGB")
-        buf = bytearray()
-        for px in image.getdata():
-            if px in PALETTE:
-                buf.append(PALETTE.index(px))
-            else:
-                buf.append(0xE6)
-        return buf
+        """
+        Internal function to convert to uncompressed 8-bit colour.
+        """
+        return self.__quantise()
 
-    def __divide_chunks(self, l: list, n: int):
-        "Helper function for splitting things into chunks"
-        for i in range(0, len(l), n):
-            yield l[i : i + n]
+    def __quantise(self) -> bytes:
+        "Helper function for the image's palette indices, quantised on first use."
+        if self.__quantised is None:
+            with stage(self.timings, "quantise"):
+                self.__quantised = quantise(self.image)
+        return self.__quantised
+
+    def __scanline(self, data: bytes, width_bytes: int) -> bytes:
+        "Helper function for Scanline compression, timed as its own step."
+        with stage(self.timings, "scanline"):
+            return scanline.compress_data_with_scanline(data, width_bytes)
+
+    @staticmethod
+    def __pack_samples(samples: np.ndarray, bits: int) -> bytes:
+        """
+        Helper function for packing 2- or 4-bit samples into bytes,
+        first pixel in the high bits. Each row starts on a new byte,
+        and the last byte of a row is padded with zeros.
+        """
+        per_byte = 8 // bits
+        height, width = samples.shape
+        padded_width = -(-width // per_byte) * per_byte
+        padded = np.zeros((height, padded_width), dtype=np.uint8)
+        padded[:, :width] = samples
+        groups = padded.reshape(height, padded_width // per_byte, per_byte)
+        packed = np.zeros(groups.shape[:2], dtype=np.uint8)
+        for index in range(per_byte):
+            packed |= groups[..., index] << (8 - bits * (index + 1))
+        return packed.tobytes()
 
 
 if __name__ == "__main__":
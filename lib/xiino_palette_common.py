@@ -1,4 +1,6 @@
 "The Xiino colour palette, used by the image decoder."
+import os
+import PIL.Image
 
 PALETTE = [
     (255, 255, 255),
@@ -233,3 +235,38 @@ PALETTE = [
     (0, 130, 130),
     (0, 0, 0),
 ]
+
+# Colour to palette index, instead of scanning PALETTE for every pixel.
+PALETTE_INDEX = {colour: index for index, colour in enumerate(PALETTE)}
+
+# Index used for colours that aren't in the palette.
+FALLBACK_INDEX = 0xE6
+
+# An image with (a superset of) the Xiino palette, for PIL's quantize().
+PALETTE_IMAGE = PIL.Image.open(os.path.join(os.path.dirname(__file__), "paletised.png"))
+
+
+def translation_table(palette: list[int]) -> bytes:
+    """
+    Build a `bytes.translate` table taking a "P" mode image's pixel values
+    to Xiino palette indices.
+
+    :param palette: The image's flat [r, g, b, r, g, b, ...] palette.
+    """
+    table = bytearray([FALLBACK_INDEX] * 256)
+    for index in range(min(len(palette) // 3, 256)):
+        colour = tuple(palette[index * 3 : index * 3 + 3])
+        table[index] = PALETTE_INDEX.get(colour, FALLBACK_INDEX)
+    return bytes(table)
+
+
+PALETTE_IMAGE_TABLE = translation_table(PALETTE_IMAGE.getpalette())
+
+
+def quantise(image: PIL.Image.Image) -> bytes:
+    """
+    Quantise an RGB image to the Xiino palette.
+    Returns one palette index per pixel, row by row.
+    """
+    quantised = image.quantize(palette=PALETTE_IMAGE)
+    return quantised.tobytes().translate(PALETTE_IMAGE_TABLE)
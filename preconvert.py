@@ -0,0 +1,263 @@
+"""
+Convert images ahead of time, into the dataserver's image cache file.
+
+Give it web pages (every image on them is converted), image URLs, or a
+directory of images along with the URL they are served from. Each image is
+converted for every chosen device profile, in parallel across all cores,
+exactly as the dataserver would convert it.
+
+Usage, from the repository root:
+    python preconvert.py --cache-file images.cache URL [URL ...]
+    python preconvert.py --cache-file images.cache --directory DIR --base-url URL
+
+Then start the dataserver with the same --cache-file. A running dataserver
+only reads the file when it starts, and saves over it when it stops.
+"""
+import argparse
+import dataclasses
+import email.utils
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import quote, urljoin
+import lib.http_client as http_client
+import lib.mode9 as mode9
+from lib.device_profile import DeviceProfile
+from lib.image_cache import CacheEntry, ImageCache
+from lib.image_pipeline import ImagePipeline
+from lib.xiino_html_converter import XiinoHTMLParser
+
+PROFILES = {
+    "colour": DeviceProfile(colour_depth=8),  # mode 9 (or 8)
+    "grey16": DeviceProfile(greyscale_depth=4),  # mode 5 (or 4)
+    "grey4": DeviceProfile(greyscale_depth=2),  # mode 3 (or 2)
+    "bw": DeviceProfile(greyscale_depth=1),  # mode 1 (or 0)
+}
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
+
+# The dataserver's defaults; bigger images would be skipped there too.
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+MAX_IMAGE_PIXELS = 25_000_000
+MAX_PAGE_BYTES = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Options:
+    "Conversion settings, which should match the dataserver's."
+
+    image_mode: str
+    mode9_engine: str
+
+
+@dataclass(frozen=True)
+class Job:
+    "One image to convert for every device profile."
+
+    url: str
+    profiles: list[DeviceProfile]
+    # read the image from here, rather than fetching `url`
+    path: str | None = None
+
+
+class ImageCollector(ImagePipeline):
+    "Takes the place of a parser's image pipeline, noting images instead of loading them."
+
+    def __init__(self) -> None:
+        super().__init__(max_workers=0)
+        self.urls: list[str] = []
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        self.urls.append(args[0])
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def convert(job: Job, options: Options) -> list[tuple[tuple, CacheEntry]]:
+    """
+    Worker side: fetch or read one image, once, and convert it for each
+    profile the way the dataserver's parser does. Returns the cache
+    entries made (none for profiles it can't be shown on).
+    """
+    parsers = [
+        XiinoHTMLParser(
+            base_url=job.url,
+            image_pipeline=ImagePipeline(max_workers=0),
+            mode9_engine=options.mode9_engine,
+            image_mode=options.image_mode,
+            device_profile=profile,
+            max_image_bytes=MAX_IMAGE_BYTES,
+            max_image_pixels=MAX_IMAGE_PIXELS,
+        )
+        for profile in job.profiles
+    ]
+
+    if job.path is None:
+        response = http_client.get(
+            job.url, timeout=10, headers=parsers[0].requests_headers, stream=True
+        )
+        response.raise_for_status()
+        content = http_client.read_limited(response, MAX_IMAGE_BYTES)
+        etag = response.headers.get("ETag")
+        modified = response.headers.get("Last-Modified")
+    else:
+        content = Path(job.path).read_bytes()
+        etag = None
+        # lets the dataserver revalidate against the served copy later
+        modified = email.utils.formatdate(os.path.getmtime(job.path), usegmt=True)
+
+    entries = []
+    for parser in parsers:
+        ebd_image = parser.convert_image(content, job.url)
+        if ebd_image is not None:
+            profile = parser.device_profile
+            key = ImageCache.key(job.url, profile.ebd_mode, profile.image_width)
+            entries.append(
+                (key, CacheEntry(ebd_image, etag=etag, last_modified=modified))
+            )
+    return entries
+
+
+def images_at(url: str) -> list[str]:
+    "The images used by the page at `url`, or just `url` if it's an image."
+    response = http_client.get(url, timeout=10, stream=True)
+    if not response.headers.get("Content-Type", "").startswith("text/html"):
+        response.close()
+        return [url]
+
+    collector = ImageCollector()
+    parser = XiinoHTMLParser(base_url=response.url, image_pipeline=collector)
+    for text in http_client.iter_text(response, MAX_PAGE_BYTES):
+        parser.feed(text)
+    parser.close()
+    # data: images aren't cached, they come with the page
+    return [image for image in collector.urls if not image.startswith("data:")]
+
+
+def images_in(directory: Path, base_url: str) -> list[tuple[str, str]]:
+    "`(url, path)` for every image under `directory`, as served from `base_url`."
+    base_url = base_url.rstrip("/") + "/"
+    return [
+        (urljoin(base_url, quote(path.relative_to(directory).as_posix())), str(path))
+        for path in sorted(directory.rglob("*"))
+        if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file()
+    ]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("urls", nargs="*", help="pages or images to convert")
+    arg_parser.add_argument(
+        "--cache-file",
+        required=True,
+        help="cache file to add to; the dataserver's --cache-file",
+    )
+    arg_parser.add_argument("--directory", type=Path, help="convert images in here")
+    arg_parser.add_argument(
+        "--base-url", help="URL the --directory is served from, e.g. http://intranet/"
+    )
+    arg_parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=PROFILES,
+        default=list(PROFILES),
+        help="device profiles to convert for: 8-bit colour, 16, 4 or 2 greys "
+        "(default: all)",
+    )
+    arg_parser.add_argument(
+        "--widths",
+        nargs="+",
+        type=int,
+        default=[153],
+        help="device viewport widths to convert for (default: 153)",
+    )
+    arg_parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="worker processes (default: one per CPU)",
+    )
+    arg_parser.add_argument(
+        "--image-mode",
+        choices=("auto", "compressed"),
+        default="auto",
+        help="as the dataserver's --image-mode (default: auto)",
+    )
+    arg_parser.add_argument(
+        "--mode9-engine",
+        choices=mode9.ENGINES,
+        default="optimal",
+        help="mode 9 encoder; the slow 'optimal' one is worth it offline "
+        "(default: optimal)",
+    )
+    arg_parser.add_argument(
+        "--image-cache-mb",
+        type=int,
+        default=32,
+        help="as the dataserver's --image-cache-mb; older entries past this "
+        "are dropped from the file (default: 32)",
+    )
+    args = arg_parser.parse_args()
+    if args.directory is not None and args.base_url is None:
+        arg_parser.error("--directory needs --base-url")
+    if not args.urls and args.directory is None:
+        arg_parser.error("give some URLs, or a --directory")
+
+    sources: dict[str, str | None] = {}  # image url -> local path
+    for url in args.urls:
+        try:
+            for image_url in images_at(url):
+                sources.setdefault(image_url, None)
+        except http_client.requests.RequestException as error:
+            print(f"Couldn't fetch {url}: {error}")
+    if args.directory is not None:
+        for image_url, path in images_in(args.directory, args.base_url):
+            sources[image_url] = path
+
+    profiles = [
+        dataclasses.replace(PROFILES[name], screen_width=width)
+        for name in args.profiles
+        for width in args.widths
+    ]
+    jobs = [Job(url, profiles, path) for url, path in sources.items()]
+    print(f"Converting {len(jobs)} images for {len(profiles)} device profiles each")
+
+    cache = ImageCache(max_bytes=args.image_cache_mb * 1024 * 1024)
+    if os.path.exists(args.cache_file):
+        cache.load(args.cache_file)
+
+    options = Options(image_mode=args.image_mode, mode9_engine=args.mode9_engine)
+    converted = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = {pool.submit(convert, job, options): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                entries = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"Failed: {job.url}: {error}")
+                failed += 1
+                continue
+            skipped += len(profiles) - len(entries)
+            for key, entry in entries:
+                cache.store(
+                    key,
+                    entry.image,
+                    etag=entry.etag,
+                    last_modified=entry.last_modified,
+                )
+                converted += 1
+
+    cache.save(args.cache_file)
+    stats = cache.stats()
+    print(
+        f"{converted} converted, {skipped} can't be shown, {failed} failed. "
+        f"{args.cache_file} now has {stats['entries']} images "
+        f"({stats['bytes'] // 1024} KiB)."
+    )
+
+
+if __name__ == "__main__":
+    main()
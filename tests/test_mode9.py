@@ -0,0 +1,78 @@
+"""
+Round trip tests for the mode 9 encoders.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+import numpy as np
+import PIL.Image
+import lib.mode9 as mode9
+from lib.xiino_palette_common import quantise
+
+
+def sample_image(width: int, height: int, seed: int) -> PIL.Image.Image:
+    """
+    A few colours in blocks, runs and noise, so every kind of code
+    (literals, RLE and copies at each offset) gets used.
+    """
+    random = np.random.default_rng(seed)
+    colours = random.integers(0, 256, (4, 3), dtype=np.uint8)
+    indices = random.integers(0, 4, (height, width))
+    indices[:, width // 3 : width // 2] = 1
+    # rows repeating the one above, shifted by -1, 0 or +1
+    for y in range(height // 2, height):
+        indices[y] = np.roll(indices[y - 1], y % 3 - 1)
+    return PIL.Image.fromarray(colours[indices], "RGB")
+
+
+class Mode9Test(unittest.TestCase):
+    "Every engine's output decodes back to the quantised image."
+
+    def test_round_trip(self):
+        for width, height in ((1, 1), (2, 5), (7, 3), (24, 24), (153, 40)):
+            image = sample_image(width, height, seed=width)
+            data = quantise(image)
+            for engine in ("python", "numpy", "optimal"):
+                with self.subTest(size=(width, height), engine=engine):
+                    encoded = mode9.compress_mode9(image, engine=engine)
+                    self.assertEqual(
+                        mode9.decompress_mode9(encoded, width, height), data
+                    )
+
+    def test_long_runs(self):
+        "Rows wider than one code can cover, e.g. on high-density devices."
+        flat = PIL.Image.new("RGB", (1000, 50), "white")
+        striped = sample_image(600, 30, seed=3).resize((1200, 30))
+        for name, image in (("flat", flat), ("striped", striped)):
+            data = quantise(image)
+            for engine in ("python", "numpy", "optimal"):
+                with self.subTest(image=name, engine=engine):
+                    encoded = mode9.compress_mode9(image, engine=engine)
+                    self.assertEqual(mode9.decompress_mode9(encoded, *image.size), data)
+
+    def test_numpy_matches_python(self):
+        for seed in range(5):
+            image = sample_image(40 + seed, 20, seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    mode9.compress_mode9(image, engine="numpy"),
+                    mode9.compress_mode9(image, engine="python"),
+                )
+
+    def test_optimal_is_smallest(self):
+        image = sample_image(153, 40, seed=1)
+        optimal = mode9.compress_mode9(image, engine="optimal")
+        self.assertLessEqual(
+            len(optimal), len(mode9.compress_mode9(image, engine="numpy"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Round trip tests for Scanline compression (modes 1, 3 and 5).
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import math
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+import numpy as np
+import PIL.Image
+import lib.scanline as scanline
+from lib.xiino_image_converter import EBDConverter
+
+# (method, keyword arguments, pixels per byte) for each compressed mode
+MODES = {
+    1: ("convert_bw", {}, 8),
+    3: ("convert_gs", {"depth": 2}, 4),
+    5: ("convert_gs", {"depth": 4}, 2),
+}
+
+# widths in pixels: a single pixel, part bytes, part groups, whole groups
+WIDTHS = (1, 3, 7, 9, 13, 16, 17, 64, 100, 153)
+
+
+def sample_image(width: int, height: int = 12) -> PIL.Image.Image:
+    """
+    Noise with some flat and repeated rows, so groups where nothing
+    changes, some bytes change, and every byte changes all turn up.
+    """
+    random = np.random.default_rng(width)
+    pixels = random.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    pixels[2:4] = 255
+    pixels[5] = pixels[4]
+    pixels[8, ::3] = pixels[7, ::3]
+    return PIL.Image.fromarray(pixels, "RGB")
+
+
+def scanline_by_line(data: bytes, width: int) -> bytes:
+    "Compress with `compress_scanline`, one line at a time."
+    lines = [data[start : start + width] for start in range(0, len(data), width)]
+    buffer = bytearray()
+    for index, line in enumerate(lines):
+        if index == 0:
+            buffer += scanline.compress_scanline(line, None, True)
+        else:
+            buffer += scanline.compress_scanline(line, lines[index - 1], False)
+    return bytes(buffer)
+
+
+class ScanlineModesTest(unittest.TestCase):
+    "Modes 1, 3 and 5 decode back to the bitmaps of modes 0, 2 and 4."
+
+    def test_round_trip(self):
+        for mode, (method, kwargs, per_byte) in MODES.items():
+            for width in WIDTHS:
+                with self.subTest(mode=mode, width=width):
+                    converter = EBDConverter(sample_image(width), True)
+                    raw = getattr(converter, method)(**kwargs).raw_data
+                    compressed = getattr(converter, method)(compressed=True, **kwargs)
+                    self.assertEqual(compressed.mode, mode)
+
+                    width_bytes = math.ceil(width / per_byte)
+                    decoded = scanline.decompress_data_with_scanline(
+                        compressed.raw_data, width_bytes, len(raw)
+                    )
+                    self.assertEqual(decoded, raw)
+
+
+class BulkScanlineTest(unittest.TestCase):
+    "compress_data_with_scanline matches compress_scanline, line by line."
+
+    def test_matches_line_by_line(self):
+        random = np.random.default_rng(0)
+        for width in (1, 5, 8, 9, 16, 20, 77):
+            # whole rows, then a short last row, then a lone short row
+            for size in (width * 6, width * 6 + width // 2 + 1, max(width - 3, 1)):
+                with self.subTest(width=width, size=size):
+                    data = random.integers(0, 3, size, dtype=np.uint8).tobytes()
+                    bulk = scanline.compress_data_with_scanline(data, width)
+                    self.assertEqual(bulk, scanline_by_line(data, width))
+                    self.assertEqual(
+                        scanline.decompress_data_with_scanline(bulk, width, size),
+                        data,
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()